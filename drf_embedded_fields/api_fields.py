@@ -1,10 +1,22 @@
-from rest_framework import serializers
+import hashlib
+import math
+import time
+from urllib.parse import urlsplit
+
 import requests
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework import serializers
 from rest_framework.exceptions import APIException
+from rest_framework.fields import SkipField
 
-from drf_embedded_fields.base import EmbeddedField
+from drf_embedded_fields.base import EmbeddedField, compile_embed_tree
+from drf_embedded_fields.circuit_breaker import get_circuit_breaker
 from drf_embedded_fields.exceptions import ServiceValidationError, \
-    CustomAPIException
+    CustomAPIException, CircuitOpenError, ResponseTooLargeError
+from drf_embedded_fields.sessions import get_session
+from drf_embedded_fields.settings import get_setting
 
 
 class APIEmbeddedMixin:
@@ -14,12 +26,27 @@ class APIEmbeddedMixin:
     url = None
     included_headers = []
     method = "get"
+    timeout = None
+    pool_size = None
+    retries = None
+    backoff_factor = None
+    cache_timeout = None
+    cache_stale_timeout = None
+    cache_alias = None
+    circuit_failure_threshold = None
+    circuit_window = None
+    circuit_cooldown = None
+    circuit_fallback = None
+    circuit_placeholder = None
+    trusted = None
+    json_loads = None
+    max_response_size = None
 
     def raise_from_response(self, response,
                             default_exception=APIException):
         status_code = response.status_code
         try:
-            data = response.json()
+            data = self.decode_response(response)
         except Exception:
             raise default_exception()
 
@@ -38,19 +65,384 @@ class APIEmbeddedMixin:
 
         raise default_exception()
 
+    def decode_response(self, response):
+        """
+        Decodes the JSON body of the response, with the json_loads option
+        when set (e.g. "orjson.loads").
+        """
+        json_loads = self.get_option("json_loads")
+        if json_loads is None:
+            return response.json()
+        if isinstance(json_loads, str):
+            json_loads = import_string(json_loads)
+        return json_loads(response.content)
+
     def parse_response(self, response):
+        if not 200 <= response.status_code < 300:
+            self.raise_from_response(response)
         try:
-            data = response.json()
+            return self.decode_response(response)
         except AttributeError:
-            data = None
+            return None
 
-        if 200 <= response.status_code < 300:
-            return data
-        self.raise_from_response(response)
+    def is_too_large(self, response, size=0):
+        """
+        Returns whether the response body, announced by its Content-Length or
+        read up to size, is over max_response_size.
+        """
+        max_size = self.get_option("max_response_size")
+        length = response.headers.get("Content-Length")
+        return size > max_size or (
+            length is not None and int(length) > max_size
+        )
+
+    def read_response(self, response):
+        """
+        Reads the body of a streamed response, aborting as soon as it is
+        over max_response_size.
+        """
+        content = bytearray()
+        if not self.is_too_large(response):
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                content += chunk
+                if self.is_too_large(response, len(content)):
+                    break
+            else:
+                response._content = bytes(content)
+                return response
+        response.close()
+        raise ResponseTooLargeError()
+
+    async def aread_response(self, response):
+        """
+        Async version of read_response, for httpx streamed responses.
+        """
+        content = bytearray()
+        try:
+            if not self.is_too_large(response):
+                async for chunk in response.aiter_bytes():
+                    content += chunk
+                    if self.is_too_large(response, len(content)):
+                        break
+                else:
+                    response._content = bytes(content)
+                    return response
+        finally:
+            await response.aclose()
+        raise ResponseTooLargeError()
+
+    def get_option(self, name):
+        """
+        Returns the value of an option of this field, falling back to the
+        DRF_EMBEDDED_FIELDS setting.
+        """
+        value = getattr(self, name)
+        if value is None:
+            return get_setting(name.upper())
+        return value
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return get_setting("CONNECT_TIMEOUT"), get_setting("READ_TIMEOUT")
+
+    def get_async_timeout(self):
+        """
+        Returns the timeout in the format of httpx: the (connect, read) pair
+        is expanded to (connect, read, write, pool), using the read timeout
+        for writes and the connect one for the pool.
+        """
+        timeout = self.get_timeout()
+        if isinstance(timeout, tuple) and len(timeout) == 2:
+            connect, read = timeout
+            return connect, read, read, connect
+        return timeout
+
+    def get_session(self, url):
+        return get_session(
+            url,
+            pool_size=self.get_option("pool_size"),
+            retries=self.get_option("retries"),
+            backoff_factor=self.get_option("backoff_factor"),
+        )
+
+    def get_cache_key(self, url, method, headers, params):
+        """
+        Returns the key of the call in the response cache, or None when the
+        response of the call should not be cached.
+
+        Since the forwarded headers are part of the key, a response is never
+        shared between different credentials.
+        """
+        if not self.get_option("cache_timeout") or method.lower() != "get":
+            return None
+        call_key = self.get_call_key(url, method, headers, params or {})
+        return "drf_embedded_fields:api:" + hashlib.sha256(
+            repr(call_key).encode()
+        ).hexdigest()
+
+    def get_cache(self):
+        return caches[self.get_option("cache_alias")]
+
+    def get_cache_entry_timeout(self):
+        """
+        Entries are kept after they expire, so they can be revalidated.
+        """
+        return self.get_option("cache_timeout") + \
+            self.get_option("cache_stale_timeout")
+
+    def get_revalidation_headers(self, headers, entry):
+        if entry is None or not entry.get("etag"):
+            return headers
+        return dict(headers, **{"If-None-Match": entry["etag"]})
+
+    def build_cache_entry(self, response, entry):
+        """
+        Parses the response, reusing the cached content when the upstream
+        answered a revalidation with 304 Not Modified, and returns the new
+        cache entry.
+        """
+        if entry is not None and response.status_code == 304:
+            data = entry["data"]
+        else:
+            data = self.parse_response(response)
+        return {
+            "data": data,
+            "etag": response.headers.get("ETag") or (entry or {}).get("etag"),
+            "expires": time.time() + self.get_option("cache_timeout"),
+        }
+
+    def get_circuit_breaker(self, url):
+        """
+        Returns the circuit breaker of the url host, or None when the circuit
+        breaker is disabled.
+        """
+        failure_threshold = self.get_option("circuit_failure_threshold")
+        if not failure_threshold:
+            return None
+        parts = urlsplit(url)
+        return get_circuit_breaker(
+            "{}://{}".format(parts.scheme, parts.netloc),
+            failure_threshold=failure_threshold,
+            window=self.get_option("circuit_window"),
+            cooldown=self.get_option("circuit_cooldown"),
+        )
+
+    def check_circuit(self, breaker):
+        if breaker is not None and not breaker.allow_request():
+            raise CircuitOpenError()
+
+    def record_response(self, breaker, response):
+        if breaker is None:
+            return
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def record_call(self, start):
+        """
+        Records an upstream call started at start in the EmbedStats of the
+        request, if it is instrumented.
+        """
+        stats = self.get_embed_stats()
+        if stats is not None:
+            stats.record(
+                self.get_embed_path(), calls=1,
+                call_time=time.perf_counter() - start
+            )
+
+    def get_response(self, url, method, headers, **kwargs):
+        kwargs.setdefault("timeout", self.get_timeout())
+        breaker = self.get_circuit_breaker(url)
+        self.check_circuit(breaker)
+        max_size = self.get_option("max_response_size")
+        if max_size is not None:
+            kwargs["stream"] = True
+        start = time.perf_counter()
+        try:
+            response = self.get_session(url).request(
+                method, url, headers=headers, **kwargs
+            )
+            if max_size is not None:
+                self.read_response(response)
+        except requests.RequestException:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        finally:
+            self.record_call(start)
+        self.record_response(breaker, response)
+        return response
+
+    async def aget_response(self, client, url, method, headers, **kwargs):
+        """
+        Async version of get_response, using the given async HTTP client.
+        """
+        kwargs.setdefault("timeout", self.get_async_timeout())
+        breaker = self.get_circuit_breaker(url)
+        self.check_circuit(breaker)
+        max_size = self.get_option("max_response_size")
+        start = time.perf_counter()
+        try:
+            if max_size is None:
+                response = await client.request(
+                    method.upper(), url, headers=headers, **kwargs
+                )
+            else:
+                response = await self.aread_response(await client.send(
+                    client.build_request(
+                        method.upper(), url, headers=headers, **kwargs
+                    ),
+                    stream=True
+                ))
+        except ResponseTooLargeError:
+            raise
+        except Exception:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        finally:
+            self.record_call(start)
+        self.record_response(breaker, response)
+        return response
+
+    def get_stale_data(self, entry, exc):
+        """
+        Returns the expired cached content when the circuit is open and the
+        stale fallback is configured, otherwise raises the exception.
+        """
+        if entry is not None and self.get_option("circuit_fallback") == "stale":
+            return entry["data"]
+        raise exc
 
     def get_from_api(self, url, method, headers, **kwargs):
-        response = getattr(requests, method)(url, headers=headers, **kwargs)
-        return self.parse_response(response)
+        cache_key = self.get_cache_key(
+            url, method, headers, kwargs.get("params")
+        )
+        if cache_key is None:
+            return self.parse_response(
+                self.get_response(url, method, headers, **kwargs)
+            )
+
+        cache = self.get_cache()
+        entry = cache.get(cache_key)
+        if entry is not None and entry["expires"] > time.time():
+            return entry["data"]
+
+        try:
+            response = self.get_response(
+                url, method, self.get_revalidation_headers(headers, entry),
+                **kwargs
+            )
+        except CircuitOpenError as exc:
+            return self.get_stale_data(entry, exc)
+        entry = self.build_cache_entry(response, entry)
+        cache.set(cache_key, entry, self.get_cache_entry_timeout())
+        return entry["data"]
+
+    async def aget_from_api(self, client, url, method, headers, **kwargs):
+        """
+        Async version of get_from_api, using the given async HTTP client.
+        """
+        cache_key = self.get_cache_key(
+            url, method, headers, kwargs.get("params")
+        )
+        if cache_key is None:
+            response = await self.aget_response(
+                client, url, method, headers, **kwargs
+            )
+            return self.parse_response(response)
+
+        cache = self.get_cache()
+        entry = await sync_to_async(cache.get)(cache_key)
+        if entry is not None and entry["expires"] > time.time():
+            return entry["data"]
+
+        try:
+            response = await self.aget_response(
+                client, url, method,
+                self.get_revalidation_headers(headers, entry), **kwargs
+            )
+        except CircuitOpenError as exc:
+            return self.get_stale_data(entry, exc)
+        entry = self.build_cache_entry(response, entry)
+        await sync_to_async(cache.set)(
+            cache_key, entry, self.get_cache_entry_timeout()
+        )
+        return entry["data"]
+
+    def get_call_key(self, url, method, headers, params):
+        return (
+            method.lower(), url, tuple(sorted(headers.items())),
+            tuple(sorted(
+                (key, tuple(value) if isinstance(value, list) else value)
+                for key, value in params.items()
+            ))
+        )
+
+    def get_request_calls(self):
+        """
+        Returns the memo of the API calls done while rendering the current
+        request, shared by every field that has access to it. Returns None
+        when there is no request in the context.
+        """
+        try:
+            request = self.get_request()
+        except KeyError:
+            return None
+        calls = getattr(request, "_embedded_api_calls", None)
+        if calls is None:
+            calls = request._embedded_api_calls = {}
+        return calls
+
+    def fetch_from_api(self, url, method, headers, params):
+        """
+        Calls get_from_api only once per distinct call in the current request,
+        returning the memoized content (or raising the memoized exception)
+        for the repeated ones.
+        """
+        calls = self.get_request_calls()
+        if calls is None:
+            return self.get_from_api(
+                url, method, headers=headers, params=params
+            )
+
+        key = self.get_call_key(url, method, headers, params)
+        if key not in calls:
+            try:
+                calls[key] = self.get_from_api(
+                    url, method, headers=headers, params=params
+                )
+            except Exception as exc:
+                calls[key] = exc
+        result = calls[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def afetch_from_api(self, client, url, method, headers, params):
+        """
+        Async version of fetch_from_api.
+        """
+        calls = self.get_request_calls()
+        if calls is None:
+            return await self.aget_from_api(
+                client, url, method, headers=headers, params=params
+            )
+
+        key = self.get_call_key(url, method, headers, params)
+        if key not in calls:
+            try:
+                calls[key] = await self.aget_from_api(
+                    client, url, method, headers=headers, params=params
+                )
+            except Exception as exc:
+                calls[key] = exc
+        result = calls[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
 
     def get_url_kwargs(self, value):
         return {}
@@ -66,16 +458,29 @@ class APIEmbeddedMixin:
         """
         return self.parent.context["request"]
 
-    def to_embedded_representation(self, value, embed_relations):
-        url = self.get_url(value)
+    def get_headers(self):
         request = self.get_request()
-
-        headers = {
+        return {
             header: request.headers.get(header)
             for header in self.included_headers if request.headers.get(header)
         }
-        params = {"embed": embed_relations}
-        embedded_data = self.get_from_api(
+
+    def get_params(self, embed_relations):
+        """
+        Returns the querystring sent to the API: the nested embed relations
+        and the requested sparse fieldsets, if any.
+        """
+        params = {"embed": list(compile_embed_tree(embed_relations).paths())}
+        for path, fields in self.embed_fieldsets.items():
+            key = "fields[{}]".format(path) if path else "fields"
+            params[key] = ",".join(fields)
+        return params
+
+    def to_embedded_representation(self, value, embed_relations):
+        url = self.get_url(value)
+        headers = self.get_headers()
+        params = self.get_params(embed_relations)
+        embedded_data = self.fetch_from_api(
             url, self.method, headers=headers, params=params
         )
         return embedded_data
@@ -91,26 +496,231 @@ class APIResourceField(APIEmbeddedMixin, EmbeddedField):
     """
     resource_url_id_key = "id"
     resource_id_attr = None
+    batch_url = None
+    batch_id_key = "id"
+    batch_size = 100
 
     def __init__(
             self, url, method="get", included_headers=None,
-            resource_url_id_key=None, resource_id_attr=None, **kwargs
+            resource_url_id_key=None, resource_id_attr=None, batch_url=None,
+            batch_id_key=None, batch_size=None, timeout=None, pool_size=None,
+            retries=None, backoff_factor=None, cache_timeout=None,
+            cache_stale_timeout=None, cache_alias=None,
+            circuit_failure_threshold=None, circuit_window=None,
+            circuit_cooldown=None, circuit_fallback=None,
+            circuit_placeholder=None, trusted=None, json_loads=None,
+            max_response_size=None, **kwargs
     ):
         super(APIResourceField, self).__init__(**kwargs)
         self.url = url
         self.method = method
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.cache_timeout = cache_timeout
+        self.cache_stale_timeout = cache_stale_timeout
+        self.cache_alias = cache_alias
+        self.circuit_failure_threshold = circuit_failure_threshold
+        self.circuit_window = circuit_window
+        self.circuit_cooldown = circuit_cooldown
+        self.circuit_fallback = circuit_fallback
+        self.circuit_placeholder = circuit_placeholder
+        self.trusted = trusted
+        self.json_loads = json_loads
+        self.max_response_size = max_response_size
         self.included_headers = included_headers or []
         self.resource_url_id_key = resource_url_id_key or self.resource_url_id_key
         self.resource_id_attr = resource_id_attr or self.resource_id_attr
+        self.batch_url = batch_url or self.batch_url
+        self.batch_id_key = batch_id_key or self.batch_id_key
+        self.batch_size = batch_size or self.batch_size
+        self.embedded_data = {}
         assert isinstance(self.included_headers, list), (
             "included_headers must be None or a list"
         )
+        assert self.batch_size > 0, "batch_size must be a positive integer"
+
+    def __copy__(self):
+        field = super(APIResourceField, self).__copy__()
+        field.embedded_data = {}
+        return field
+
+    def clear_embedded(self):
+        super(APIResourceField, self).clear_embedded()
+        self.embedded_data.clear()
+        calls = self.get_request_calls()
+        if calls:
+            calls.clear()
 
     def get_url_kwargs(self, value):
         id_attr_val = getattr(value, self.resource_id_attr) if \
             self.resource_id_attr else str(value)
         return {self.resource_url_id_key: id_attr_val}
 
+    def get_resource_id(self, value):
+        return str(self.get_url_kwargs(value)[self.resource_url_id_key])
+
+    def get_batch_url(self, resource_ids):
+        return self.batch_url.format(ids=",".join(resource_ids))
+
+    def get_batch_results(self, data):
+        """
+        Returns the list of resources from a batch response, supporting
+        paginated responses with a results key.
+        """
+        if isinstance(data, dict):
+            return data.get("results", [])
+        return data or []
+
+    def get_embed_cost(self, rows, instances=None):
+        """
+        One request per distinct resource, or per batch of them. When the
+        instances are given, their distinct resource ids not retrieved yet
+        are counted instead of the rows.
+        """
+        if instances is not None:
+            rows = len(self.get_embed_values(instances))
+        if self.batch_url:
+            return 0, math.ceil(rows / self.batch_size)
+        return 0, rows
+
+    def get_embed_values(self, instances):
+        """
+        Returns the distinct values to be embedded for the given instances,
+        keyed by their resource id, skipping the ones already retrieved.
+        """
+        values = {}
+        for instance in instances:
+            try:
+                attribute = self.get_attribute(instance)
+            except SkipField:
+                continue
+            if attribute is None:
+                continue
+            value = self.get_embed_value(attribute)
+            resource_id = self.get_resource_id(value)
+            if resource_id not in self.embedded_data:
+                values.setdefault(resource_id, value)
+        return values
+
+    def get_prefetch_calls(self, instances):
+        """
+        Returns the API calls needed to embed all the given instances, as
+        (resource_ids, url, headers, params) tuples. With a batch_url, each
+        call retrieves up to batch_size ids, otherwise one call per id.
+        """
+        values = self.get_embed_values(instances)
+        headers = self.get_headers()
+        params = self.get_params(self.embed_relations)
+        if not self.batch_url:
+            return [
+                ((resource_id,), self.get_url(value), headers, params)
+                for resource_id, value in values.items()
+            ]
+
+        resource_ids = list(values)
+        return [
+            (
+                tuple(resource_ids[start:start + self.batch_size]),
+                self.get_batch_url(resource_ids[start:start + self.batch_size]),
+                headers, params
+            )
+            for start in range(0, len(resource_ids), self.batch_size)
+        ]
+
+    def set_prefetch_result(self, resource_ids, data):
+        if not self.batch_url:
+            self.embedded_data[resource_ids[0]] = data
+            return
+        for resource in self.get_batch_results(data):
+            self.embedded_data[str(resource[self.batch_id_key])] = resource
+
+    def set_prefetch_error(self, resource_ids, exc):
+        for resource_id in resource_ids:
+            self.embedded_data[resource_id] = exc
+
+    def run_prefetch_call(self, call):
+        """
+        Executes a call returned by get_prefetch_calls, storing either its
+        content or the raised exception for each of its resource ids.
+        """
+        resource_ids, url, headers, params = call
+        try:
+            data = self.fetch_from_api(
+                url, self.method, headers=headers, params=params
+            )
+        except Exception as exc:
+            self.set_prefetch_error(resource_ids, exc)
+        else:
+            self.set_prefetch_result(resource_ids, data)
+
+    async def arun_prefetch_call(self, client, call):
+        """
+        Async version of run_prefetch_call, using the given async HTTP client.
+        """
+        resource_ids, url, headers, params = call
+        try:
+            data = await self.afetch_from_api(
+                client, url, self.method, headers=headers, params=params
+            )
+        except Exception as exc:
+            self.set_prefetch_error(resource_ids, exc)
+        else:
+            self.set_prefetch_result(resource_ids, data)
+
+    def prefetch_embedded(self, instances):
+        """
+        When a batch_url is set, retrieves the content of all instances with
+        batch requests of at most batch_size ids each.
+        """
+        if not self.batch_url:
+            return
+        for call in self.get_prefetch_calls(instances):
+            self.run_prefetch_call(call)
+
+    def to_representation(self, value):
+        """
+        When the upstream circuit is open, renders the configured fallback:
+        the raw value for "id", the circuit_placeholder for "placeholder" or
+        raises the error otherwise.
+        """
+        try:
+            return super(APIResourceField, self).to_representation(value)
+        except CircuitOpenError:
+            fallback = self.get_option("circuit_fallback")
+            if fallback == "id":
+                return self.get_embed_value(value)
+            if fallback == "placeholder":
+                return self.get_option("circuit_placeholder")
+            raise
+
+    def render_embedded(self, serializer, data):
+        """
+        The content of trusted upstreams is rendered as decoded, skipping the
+        serializer, only projected to the requested sparse fields.
+        """
+        if not self.get_option("trusted"):
+            return super(APIResourceField, self).render_embedded(
+                serializer, data
+            )
+        fields = self.get_sparse_fields()
+        if fields is None or not isinstance(data, dict):
+            return data
+        return {key: data[key] for key in fields if key in data}
+
+    def to_embedded_representation(self, value, embed_relations):
+        if self.embedded_data:
+            resource_id = self.get_resource_id(value)
+            if resource_id in self.embedded_data:
+                data = self.embedded_data[resource_id]
+                if isinstance(data, Exception):
+                    raise data
+                return data
+        return super(APIResourceField, self).to_embedded_representation(
+            value, embed_relations
+        )
+
 
 class APIResourceIntField(APIResourceField, serializers.IntegerField):
     pass
@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+
+
+class EmbeddedFieldsConfig(AppConfig):
+    name = "drf_embedded_fields"
+    verbose_name = "DRF Embedded Fields"
+
+    def ready(self):
+        from drf_embedded_fields.model_fields import \
+            build_default_embedded_serializers
+        build_default_embedded_serializers()
+
+        from drf_embedded_fields.render_cache import \
+            uses_render_invalidation, connect_invalidations
+        if uses_render_invalidation():
+            connect_invalidations()
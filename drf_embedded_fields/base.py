@@ -1,5 +1,22 @@
+import asyncio
+import re
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
 
+from drf_embedded_fields.instrumentation import get_embed_stats, \
+    measure_embed
+from drf_embedded_fields.routing import route_queryset
+from drf_embedded_fields.settings import get_setting, get_callable_setting
+
 
 def split_embed_relations(embed_fields_list):
     embed_relations = {}
@@ -11,6 +28,124 @@ def split_embed_relations(embed_fields_list):
     return embed_relations
 
 
+class EmbedTree(Mapping):
+    """
+    Immutable tree of the embedded fields, mapping each field name to the
+    EmbedTree of its own embedded fields.
+    """
+    __slots__ = ("_children", "_hash")
+
+    def __init__(self, children=None):
+        self._children = dict(children or {})
+        self._hash = None
+
+    def __getitem__(self, name):
+        return self._children[name]
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._children.items()))
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, EmbedTree):
+            return self._children == other._children
+        return NotImplemented
+
+    def __repr__(self):
+        return "EmbedTree({})".format(list(self.paths()))
+
+    def paths(self):
+        """
+        Yields the dotted path of every leaf, e.g. ["parent.root"].
+        """
+        for name, subtree in self._children.items():
+            if not subtree:
+                yield name
+            for path in subtree.paths():
+                yield name + "." + path
+
+    @property
+    def depth(self):
+        return max(
+            (subtree.depth + 1 for subtree in self._children.values()),
+            default=0
+        )
+
+    @property
+    def size(self):
+        """
+        Number of embedded paths, counting the intermediate ones.
+        """
+        return sum(subtree.size + 1 for subtree in self._children.values())
+
+
+def _build_embed_tree(embed_fields):
+    children = {}
+    for path, subpaths in split_embed_relations(embed_fields).items():
+        if path:
+            children[path] = _build_embed_tree(subpaths)
+    return EmbedTree(children)
+
+
+@lru_cache(maxsize=256)
+def _compile_embed_tree(embed_fields):
+    return _build_embed_tree(embed_fields)
+
+
+def compile_embed_tree(embed_fields):
+    """
+    Parses a list of dotted embed paths, e.g. ["parent.root", "children"],
+    into an EmbedTree. Trees are cached by their list of paths, as clients
+    usually send only a few distinct embed querystrings.
+    """
+    if isinstance(embed_fields, EmbedTree):
+        return embed_fields
+    return _compile_embed_tree(tuple(embed_fields or ()))
+
+
+EMBED_FIELDSET_PARAM = re.compile(r"^fields\[(?P<path>[\w.]+)\]$")
+
+
+def parse_embed_fieldsets(query_params):
+    """
+    Returns the sparse fieldsets sent in the querystring, as
+    ?fields[parent]=id,str_field&fields[parent.root]=name, keyed by the path
+    of the embedded field.
+    """
+    fieldsets = {}
+    for key in query_params.keys():
+        match = EMBED_FIELDSET_PARAM.match(key)
+        if not match:
+            continue
+        fieldsets[match.group("path")] = [
+            name.strip()
+            for value in query_params.getlist(key)
+            for name in value.split(",") if name.strip()
+        ]
+    return fieldsets
+
+
+def split_embed_fieldsets(fieldsets):
+    """
+    Splits the fieldsets by their first field, with the remaining path
+    relative to it. The fieldset of the field itself is kept under "".
+    """
+    embed_fieldsets = {}
+    for path, fields in fieldsets.items():
+        field, *field_path = path.split(".", maxsplit=1)
+        embed_fieldsets.setdefault(field, {})[
+            field_path[0] if field_path else ""
+        ] = fields
+    return embed_fieldsets
+
+
 class EmbeddedFieldMixin:
     """
     EmbeddedField will either return to representation the original field or
@@ -26,41 +161,246 @@ class EmbeddedFieldMixin:
     """
     embed_serializer_class = None
     embed = True
-    embed_relations = []
+    embed_relations = EmbedTree()
+    embed_fieldsets = {}
+    embed_using = None
+
+    def __copy__(self):
+        """
+        Returns an unbound copy sharing the arguments of this field but not
+        its embedded content caches, cheaper than a deepcopy.
+        """
+        field = self.__class__.__new__(self.__class__)
+        field.__dict__.update(self.__dict__)
+        field.embed_serializers = {}
+        return field
 
     def get_embed_serializer_class(self):
         return self.embed_serializer_class or serializers.DictField
 
-    def get_serializer(self, value, embed_relations, **kwargs):
+    def get_embed_path(self):
+        """
+        Returns the dotted path of this field from the root serializer, e.g.
+        "parent.root". The child relation of a many field shares its path.
+        """
+        if isinstance(self.parent, serializers.ManyRelatedField):
+            return self.parent.get_embed_path()
+        return self.parent.context.get("embed_prefix", "") + self.field_name
+
+    def route_queryset(self, queryset):
+        """
+        Returns the queryset using the database the embed queries of this
+        field are sent to.
+        """
+        return route_queryset(
+            queryset, self.context.get("request"), self.embed_using
+        )
+
+    def get_embed_stats(self):
+        return get_embed_stats(self.context.get("request"))
+
+    def measure_embed(self):
+        """
+        Returns a context manager recording the rendering of this field in
+        the EmbedStats of the request, doing nothing when it is not
+        instrumented.
+        """
+        stats = self.get_embed_stats()
+        if stats is None or isinstance(
+                self.parent, serializers.ManyRelatedField
+        ):
+            return nullcontext()
+        return measure_embed(stats, self.get_embed_path())
+
+    def get_sparse_fields(self):
+        """
+        Returns the fields requested for the embedded content, or None when
+        all of them should be rendered.
+        """
+        return self.embed_fieldsets.get("")
+
+    def build_serializer(self, embed_relations, **kwargs):
         serializer_class = self.get_embed_serializer_class()
         if issubclass(serializer_class, serializers.BaseSerializer):
-            context = self.parent.context
-            context.update({"embed_fields": embed_relations})
+            context = dict(
+                self.parent.context,
+                embed_fields=compile_embed_tree(embed_relations),
+                embed_fieldsets=self.embed_fieldsets,
+                embed_prefix=self.get_embed_path() + "."
+            )
             return serializer_class(context=context, **kwargs)
         return serializer_class(**kwargs)
 
+    def get_serializer(self, value, embed_relations, **kwargs):
+        """
+        Returns the serializer that renders the embedded value. It is built
+        once per embed_relations and fieldsets and reused for every value of
+        this field.
+        """
+        if kwargs:
+            return self.build_serializer(embed_relations, **kwargs)
+
+        key = (compile_embed_tree(embed_relations), tuple(sorted(
+            (path, tuple(fields))
+            for path, fields in self.embed_fieldsets.items()
+        )))
+        if key not in self.embed_serializers:
+            self.embed_serializers[key] = self.build_serializer(
+                embed_relations
+            )
+        return self.embed_serializers[key]
+
+    def get_embedded_serializer(self):
+        """
+        Returns the serializer of the embedded content for the current
+        embed_relations.
+        """
+        return self.get_serializer(None, self.embed_relations)
+
+    def get_embed_cost(self, rows, instances=None):
+        """
+        Returns the estimated (queries, requests) needed to embed this field
+        for the given number of rows. The instances are given when they are
+        already loaded, e.g. for the top level list, allowing a closer
+        estimate.
+        """
+        return 0, 0
+
+    def prefetch_embedded(self, instances):
+        """
+        Called with all instances of a list before they are serialized, so the
+        embedded content can be resolved for all of them at once.
+        """
+        pass
+
+    def clear_embedded(self):
+        """
+        Drops the embedded content resolved so far, so the memory used by a
+        streamed list is bounded by its chunk size.
+        """
+        for serializer in self.embed_serializers.values():
+            if hasattr(serializer, "clear_embedded"):
+                serializer.clear_embedded()
+
     def to_embedded_representation(self, value, embed_relations):
         raise NotImplementedError()
 
 
 class EmbeddedField(EmbeddedFieldMixin):
     def __init__(self, *args, embed=False, embed_relations=None,
-                 embed_serializer_class=None, **kwargs):
+                 embed_serializer_class=None, embed_using=None, **kwargs):
         super(EmbeddedField, self).__init__(*args, **kwargs)
         self.embed_serializer_class = embed_serializer_class
-        self.embed_relations = embed_relations or []
+        self.embed_using = embed_using
+        self.embed_relations = compile_embed_tree(embed_relations)
         self.embed = embed
+        self.embed_serializers = {}
+
+    def get_embed_value(self, value):
+        """
+        Returns the value that is sent to to_embedded_representation. By
+        default it is the same value the field would render when not embedded.
+        """
+        return super(EmbeddedField, self).to_representation(value)
+
+    def render_embedded(self, serializer, value):
+        return serializer.to_representation(value)
 
     def to_representation(self, value):
-        field_value = super(EmbeddedField, self).to_representation(value)
         if self.embed:
-            serializer = self.get_serializer(field_value, self.embed_relations)
-            embedded_value = self.to_embedded_representation(
-                field_value, self.embed_relations
+            with self.measure_embed():
+                field_value = self.get_embed_value(value)
+                serializer = self.get_serializer(
+                    field_value, self.embed_relations
+                )
+                embedded_value = self.to_embedded_representation(
+                    field_value, self.embed_relations
+                )
+                return self.render_embedded(serializer, embedded_value)
+
+        return super(EmbeddedField, self).to_representation(value)
+
+
+class EmbeddableListSerializer(serializers.ListSerializer):
+    """
+    ListSerializer that lets the child embedded fields resolve their content
+    for the whole list before the items are serialized one by one.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(
+            data, models.manager.BaseManager
+        ) else data
+        instances = list(iterable)
+        if self.child.embed_from_request:
+            self.child.check_embed_cost(len(instances), instances)
+        self.child.prefetch_embedded(instances)
+        return super(EmbeddableListSerializer, self).to_representation(
+            instances
+        )
+
+    def iter_representation(self, data, chunk_size):
+        """
+        Yields the representation of each instance, resolving the embedded
+        content of chunk_size instances at a time and dropping it after, so
+        the memory used does not grow with the number of instances. The embed
+        budget is checked for each chunk.
+        """
+        if isinstance(data, models.manager.BaseManager):
+            data = data.all()
+        lookups = ()
+        if isinstance(data, models.QuerySet):
+            lookups = data._prefetch_related_lookups
+            iterator = data.prefetch_related(None).iterator(
+                chunk_size=chunk_size
             )
-            return serializer.to_representation(embedded_value)
+        else:
+            iterator = iter(data)
+
+        while True:
+            instances = list(islice(iterator, chunk_size))
+            if not instances:
+                return
+            if lookups:
+                prefetch_related_objects(instances, *lookups)
+            if self.child.embed_from_request:
+                self.child.check_embed_cost(len(instances), instances)
+            self.child.prefetch_embedded(instances)
+            for instance in instances:
+                yield self.child.to_representation(instance)
+            self.child.clear_embedded()
 
-        return field_value
+    def create(self, validated_data):
+        """
+        Lets the child create all the instances at once when it opts in,
+        e.g. in bulk.
+        """
+        uses_bulk_create = getattr(self.child, "uses_bulk_create", None)
+        if uses_bulk_create is not None and uses_bulk_create():
+            return self.child.create_many(validated_data)
+        return super(EmbeddableListSerializer, self).create(validated_data)
+
+    def to_internal_value(self, data):
+        if isinstance(data, list) and \
+                hasattr(self.child, "preload_internal_values"):
+            self.child.preload_internal_values(data)
+        return super(EmbeddableListSerializer, self).to_internal_value(data)
+
+    async def adata(self, client=None):
+        """
+        Async version of data. The API embedded content of all instances is
+        retrieved concurrently with asyncio before serializing them.
+        """
+        iterable = self.instance.all() if isinstance(
+            self.instance, models.manager.BaseManager
+        ) else self.instance
+        self.instance = await sync_to_async(list)(iterable)
+        if self.child.embed_from_request:
+            await sync_to_async(self.child.check_embed_cost)(
+                len(self.instance), self.instance
+            )
+        await self.child.aprefetch_embedded(self.instance, client)
+        return await sync_to_async(lambda: self.data)()
 
 
 class EmbeddableSerializerMixin:
@@ -70,21 +410,264 @@ class EmbeddableSerializerMixin:
     It will handle the control if a certain field should use the embedded
     content or the default.
 
+    When used with many=True, the EmbeddableListSerializer is used unless the
+    Meta class defines another list_serializer_class.
     """
+    embed_max_workers = None
+    embed_max_depth = None
+    embed_max_paths = None
+    embed_max_queries = None
+    embed_max_requests = None
+
+    def __init_subclass__(cls, **kwargs):
+        super(EmbeddableSerializerMixin, cls).__init_subclass__(**kwargs)
+        meta = cls.__dict__.get("Meta")
+        if meta is None and not hasattr(cls, "Meta"):
+            cls.Meta = type("Meta", (), {})
+            meta = cls.Meta
+        if meta is not None and not hasattr(meta, "list_serializer_class"):
+            meta.list_serializer_class = EmbeddableListSerializer
 
     def __init__(self, *args, **kwargs):
         super(EmbeddableSerializerMixin, self).__init__(*args, **kwargs)
         embed_fields = self.context.get("embed_fields", None)
+        self.embed_from_request = embed_fields is None
         if embed_fields is None:
             assert "request" in self.context, "This serializer requires that the " \
                                               "request is sent in the context."
             embed_fields = self.context["request"].query_params.getlist("embed")
 
-        self.embed_fields = split_embed_relations(
-            embed_fields
-        )
+        self.embed_fields = compile_embed_tree(embed_fields)
+        if self.embed_from_request:
+            self.validate_embed_limits(self.embed_fields)
         for name, embed_relations in self.embed_fields.items():
             if name in self.fields:
                 self.fields[name].embed = True
                 self.fields[name].embed_relations = embed_relations
 
+        embed_fieldsets = self.context.get("embed_fieldsets", None)
+        if embed_fieldsets is None:
+            request = self.context.get("request", None)
+            embed_fieldsets = parse_embed_fieldsets(
+                request.query_params
+            ) if request is not None else {}
+
+        sparse_fields = embed_fieldsets.get("")
+        self.sparse_excluded_fields = set()
+        if sparse_fields is not None:
+            for name in list(self.fields):
+                if name not in sparse_fields:
+                    self.fields.pop(name)
+                    self.sparse_excluded_fields.add(name)
+
+        self.embed_fieldsets = split_embed_fieldsets({
+            path: fields for path, fields in embed_fieldsets.items() if path
+        })
+        for name, fieldsets in self.embed_fieldsets.items():
+            if name in self.fields:
+                self.fields[name].embed_fieldsets = fieldsets
+
+        if self.embed_from_request:
+            self.validate_embed_fields()
+
+    def preload_internal_values(self, data):
+        """
+        Lets the fields load the instances referenced by the given input
+        objects in bulk, before the objects are validated one by one.
+        """
+        for field in self._writable_fields:
+            if hasattr(field, "preload_internal_values"):
+                field.preload_internal_values([
+                    item[field.field_name] for item in data
+                    if isinstance(item, Mapping) and field.field_name in item
+                ])
+
+    def to_internal_value(self, data):
+        if isinstance(data, Mapping):
+            self.preload_internal_values([data])
+        return super(EmbeddableSerializerMixin, self).to_internal_value(data)
+
+    def get_embed_max_workers(self):
+        if self.embed_max_workers is not None:
+            return self.embed_max_workers
+        return get_setting("MAX_WORKERS")
+
+    def prefetch_embedded(self, instances):
+        """
+        Lets each embedded field prefetch its content for the instances. When
+        embed_max_workers is set, the API calls of all fields are gathered
+        and executed concurrently in a thread pool.
+        """
+        max_workers = self.get_embed_max_workers()
+        calls = []
+        for field in self.fields.values():
+            if not getattr(field, "embed", False):
+                continue
+            if max_workers and hasattr(field, "get_prefetch_calls"):
+                calls.extend(
+                    (field, call)
+                    for call in field.get_prefetch_calls(instances)
+                )
+            elif hasattr(field, "prefetch_embedded"):
+                with field.measure_embed():
+                    field.prefetch_embedded(instances)
+
+        if calls:
+            with ThreadPoolExecutor(
+                    max_workers=min(max_workers, len(calls))
+            ) as executor:
+                list(executor.map(
+                    lambda item: item[0].run_prefetch_call(item[1]), calls
+                ))
+
+    def get_async_client(self):
+        try:
+            client_class = get_callable_setting("ASYNC_CLIENT")
+        except ImportError as exc:
+            raise ImproperlyConfigured(
+                "The async serialization requires httpx to be installed or "
+                "an ASYNC_CLIENT in the DRF_EMBEDDED_FIELDS setting."
+            ) from exc
+        return client_class()
+
+    async def aprefetch_embedded(self, instances, client=None):
+        """
+        Async version of prefetch_embedded. The API calls of all fields are
+        executed concurrently with asyncio.gather through the async client.
+        """
+        if client is None:
+            async with self.get_async_client() as client:
+                return await self.aprefetch_embedded(instances, client)
+
+        calls = []
+        for field in self.fields.values():
+            if not getattr(field, "embed", False):
+                continue
+            if hasattr(field, "get_prefetch_calls"):
+                field_calls = await sync_to_async(field.get_prefetch_calls)(
+                    instances
+                )
+                calls.extend((field, call) for call in field_calls)
+            elif hasattr(field, "prefetch_embedded"):
+                await sync_to_async(field.prefetch_embedded)(instances)
+
+        await asyncio.gather(*(
+            field.arun_prefetch_call(client, call) for field, call in calls
+        ))
+
+    async def adata(self, client=None):
+        """
+        Async version of data. The API embedded content is retrieved
+        concurrently with asyncio before the serialization.
+        """
+        if self.instance is not None:
+            if self.embed_from_request:
+                await sync_to_async(self.check_embed_cost)(
+                    1, [self.instance]
+                )
+            await self.aprefetch_embedded([self.instance], client)
+        return await sync_to_async(lambda: self.data)()
+
+    def clear_embedded(self):
+        for field in self.fields.values():
+            if hasattr(field, "clear_embedded"):
+                field.clear_embedded()
+
+    def get_embed_option(self, name):
+        value = getattr(self, name)
+        if value is None:
+            return get_setting(name.upper())
+        return value
+
+    def validate_embed_limits(self, embed_tree):
+        """
+        Rejects the embed querystring when it is deeper or has more embedded
+        paths than allowed.
+        """
+        max_depth = self.get_embed_option("embed_max_depth")
+        if max_depth is not None and embed_tree.depth > max_depth:
+            raise serializers.ValidationError({"embed": [
+                "The embed depth of {} exceeds the maximum of {}.".format(
+                    embed_tree.depth, max_depth
+                )
+            ]})
+        max_paths = self.get_embed_option("embed_max_paths")
+        if max_paths is not None and embed_tree.size > max_paths:
+            raise serializers.ValidationError({"embed": [
+                "The {} embedded paths exceed the maximum of {}.".format(
+                    embed_tree.size, max_paths
+                )
+            ]})
+
+    def get_unknown_embed_fields(self, embed_tree, prefix=""):
+        """
+        Returns the paths of the embed tree that do not match a field. The
+        embedded content of non serializer fields (e.g. API fields) is not
+        checked, nor the fields left out by the sparse fieldsets, which are
+        not rendered.
+        """
+        unknown = []
+        for name, subtree in embed_tree.items():
+            field = self.fields.get(name)
+            if field is None:
+                if name not in self.sparse_excluded_fields:
+                    unknown.append(prefix + name)
+                continue
+            if not subtree or not hasattr(field, "get_embedded_serializer"):
+                continue
+            serializer = field.get_embedded_serializer()
+            if isinstance(serializer, EmbeddableSerializerMixin):
+                unknown.extend(serializer.get_unknown_embed_fields(
+                    subtree, prefix=prefix + name + "."
+                ))
+        return unknown
+
+    def validate_embed_fields(self):
+        unknown = self.get_unknown_embed_fields(self.embed_fields)
+        if unknown:
+            raise serializers.ValidationError({"embed": [
+                "Unknown embed field(s): {}.".format(", ".join(unknown))
+            ]})
+
+    def get_embed_cost(self, rows, instances=None):
+        """
+        Returns the estimated (queries, requests) needed to embed the fields
+        of the given number of rows, or of the given instances.
+        """
+        queries = requests = 0
+        for field in self.fields.values():
+            if getattr(field, "embed", False) and \
+                    hasattr(field, "get_embed_cost"):
+                field_queries, field_requests = field.get_embed_cost(
+                    rows, instances
+                )
+                queries += field_queries
+                requests += field_requests
+        return queries, requests
+
+    def check_embed_cost(self, rows, instances=None):
+        """
+        Rejects the serialization of the given number of rows, or of the
+        given instances, when its estimated embed cost is over the query or
+        request budget.
+        """
+        queries, requests = self.get_embed_cost(rows, instances)
+        max_queries = self.get_embed_option("embed_max_queries")
+        if max_queries is not None and queries > max_queries:
+            raise serializers.ValidationError({"embed": [
+                "The embedded fields would need about {} database queries, "
+                "exceeding the maximum of {}.".format(queries, max_queries)
+            ]})
+        max_requests = self.get_embed_option("embed_max_requests")
+        if max_requests is not None and requests > max_requests:
+            raise serializers.ValidationError({"embed": [
+                "The embedded fields would need about {} API requests, "
+                "exceeding the maximum of {}.".format(requests, max_requests)
+            ]})
+
+    @property
+    def data(self):
+        if self.embed_from_request and self.instance is not None and \
+                not hasattr(self, "_data"):
+            self.check_embed_cost(1, [self.instance])
+        return super(EmbeddableSerializerMixin, self).data
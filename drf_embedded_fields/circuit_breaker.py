@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import deque
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    Keeps track of the failures of an upstream service.
+
+    After failure_threshold failures within window seconds the circuit opens
+    and the calls fail fast for cooldown seconds. Then the circuit becomes
+    half-open: a single trial call is let through while the others keep
+    failing fast, and it either closes the circuit when it succeeds or opens
+    it again when it fails. A trial that records neither is given up after
+    another cooldown.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold, window, cooldown):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.failures = deque()
+        self.opened_at = None
+        self.trial_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self):
+        with self.lock:
+            state = self.state
+            if state != self.HALF_OPEN:
+                return state == self.CLOSED
+            now = time.monotonic()
+            if self.trial_at is not None and \
+                    now - self.trial_at < self.cooldown:
+                return False
+            self.trial_at = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures.clear()
+            self.opened_at = None
+            self.trial_at = None
+
+    def record_failure(self):
+        now = time.monotonic()
+        with self.lock:
+            self.trial_at = None
+            if self.opened_at is not None:
+                # A failed half-open call opens the circuit again.
+                self.opened_at = now
+                return
+            self.failures.append(now)
+            while self.failures and now - self.failures[0] > self.window:
+                self.failures.popleft()
+            if len(self.failures) >= self.failure_threshold:
+                self.opened_at = now
+                self.failures.clear()
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "failures": len(self.failures),
+            "failure_threshold": self.failure_threshold,
+            "window": self.window,
+            "cooldown": self.cooldown,
+        }
+
+
+def get_circuit_breaker(name, failure_threshold, window, cooldown):
+    """
+    Returns the process-wide circuit breaker of the given name, creating it
+    with the given options the first time.
+    """
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.setdefault(
+                name,
+                CircuitBreaker(name, failure_threshold, window, cooldown)
+            )
+    return breaker
+
+
+def get_circuit_breakers():
+    """
+    Returns the state of every circuit breaker, keyed by their name.
+    """
+    return {
+        name: breaker.as_dict()
+        for name, breaker in list(_circuit_breakers.items())
+    }
+
+
+def reset_circuit_breakers():
+    with _circuit_breakers_lock:
+        _circuit_breakers.clear()
@@ -1,3 +1,6 @@
+from rest_framework.exceptions import APIException
+
+
 class CustomAPIException(Exception):
     status_code = None
 
@@ -11,3 +14,15 @@ class CustomAPIException(Exception):
 
 class ServiceValidationError(CustomAPIException):
     status_code = 400
+
+
+class CircuitOpenError(APIException):
+    status_code = 503
+    default_detail = "The upstream service is temporarily unavailable."
+    default_code = "circuit_open"
+
+
+class ResponseTooLargeError(APIException):
+    status_code = 502
+    default_detail = "The upstream response exceeds the maximum size."
+    default_code = "response_too_large"
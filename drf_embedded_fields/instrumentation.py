@@ -0,0 +1,116 @@
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+from django.dispatch import Signal
+
+from drf_embedded_fields.settings import get_setting, get_callable_setting
+
+# Sent once per response with the collected EmbedStats, when instrumentation
+# is enabled. Arguments: request, stats.
+embed_stats_collected = Signal()
+
+
+class EmbedStats:
+    """
+    Time, database queries and upstream calls spent embedding each field
+    while rendering a response, keyed by the dotted embed path of the field
+    (e.g. "parent.root"). The measures of a field include the ones of its
+    own embedded fields.
+
+    count is the number of times the field was rendered or prefetched.
+    """
+    measures = ("count", "time", "queries", "calls", "call_time")
+
+    def __init__(self):
+        self.fields = {}
+        self.lock = threading.Lock()
+
+    def record(self, path, **values):
+        with self.lock:
+            field = self.fields.get(path)
+            if field is None:
+                field = self.fields[path] = dict.fromkeys(self.measures, 0)
+            for measure, value in values.items():
+                field[measure] += value
+
+    def as_dict(self):
+        with self.lock:
+            return {path: dict(field) for path, field in self.fields.items()}
+
+    def get_server_timing(self):
+        """
+        Returns the Server-Timing header value, with one metric per field.
+        """
+        return ", ".join(
+            'embed.{};dur={:.2f};desc="{} queries, {} calls"'.format(
+                path, field["time"] * 1000, field["queries"], field["calls"]
+            )
+            for path, field in self.as_dict().items()
+        )
+
+
+def start_embed_stats(request):
+    """
+    Enables the instrumentation of the embedded fields rendered for the
+    request, returning its EmbedStats.
+    """
+    request._embed_stats = EmbedStats()
+    return request._embed_stats
+
+
+def get_embed_stats(request):
+    """
+    Returns the EmbedStats of the request, or None when it is not
+    instrumented.
+    """
+    return getattr(request, "_embed_stats", None)
+
+
+def report_embed_stats(request, response=None):
+    """
+    Sends the embed_stats_collected signal and calls the INSTRUMENTATION_HOOK
+    with the stats of the request, adding the Server-Timing header to the
+    response when SERVER_TIMING is set.
+    """
+    stats = get_embed_stats(request)
+    if stats is None:
+        return
+    embed_stats_collected.send(
+        sender=EmbedStats, request=request, stats=stats
+    )
+    hook = get_callable_setting("INSTRUMENTATION_HOOK")
+    if hook is not None:
+        hook(request, stats)
+    if response is not None and get_setting("SERVER_TIMING") and stats.fields:
+        server_timing = stats.get_server_timing()
+        if response.has_header("Server-Timing"):
+            server_timing = response["Server-Timing"] + ", " + server_timing
+        response["Server-Timing"] = server_timing
+
+
+@contextmanager
+def measure_embed(stats, path):
+    """
+    Records the time and database queries of the block for the field at
+    path. The queries of every database are counted, e.g. when the embed
+    queries are routed to a replica.
+    """
+    queries = 0
+
+    def count_query(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count_query))
+            yield
+    finally:
+        stats.record(
+            path, count=1, time=time.perf_counter() - start, queries=queries
+        )
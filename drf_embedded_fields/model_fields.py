@@ -1,28 +1,78 @@
+import copy
 import inspect
+from collections.abc import Mapping
+from contextlib import contextmanager
 
+import django
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist, \
+    EmptyResultSet, ImproperlyConfigured, ObjectDoesNotExist, \
+    ValidationError as DjangoValidationError
+from django.db import connections, models, router, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
 from rest_framework import serializers
-from rest_framework.relations import MANY_RELATION_KWARGS
+from rest_framework.fields import SkipField, get_attribute
+from rest_framework.relations import MANY_RELATION_KWARGS, PKOnlyObject
+from rest_framework.serializers import raise_errors_on_nested_writes
 
 from drf_embedded_fields.base import EmbeddedField, EmbeddableSerializerMixin, \
-    EmbeddedFieldMixin
+    EmbeddedFieldMixin, compile_embed_tree
+from drf_embedded_fields.render_cache import get_render_variant, \
+    get_cached_renders, set_cached_renders, check_render_invalidation
+from drf_embedded_fields.settings import get_setting
+from drf_embedded_fields.writes import build_embedded_instance, \
+    get_embedded_writes, save_embedded_writes
+
+
+_embeddable_fields = {}
+
+# Filtering on window functions requires Django 4.2, older versions limit the
+# related instances of reverse relations in Python.
+WINDOW_FILTERS = django.VERSION >= (4, 2)
+
+
+def clear_embeddable_fields_cache():
+    """
+    Clears the fields cached by EmbeddableModelSerializer.get_fields, e.g.
+    after changing a serializer's Meta in tests.
+    """
+    _embeddable_fields.clear()
 
 
 class EmbeddableModelSerializer(
     EmbeddableSerializerMixin, serializers.ModelSerializer
 ):
     def get_fields(self):
+        """
+        The fields are built and rewritten as embedded fields once per
+        serializer class, and every instance gets its own copy of them.
+        """
+        serializer_class = self.__class__
+        if serializer_class not in _embeddable_fields:
+            _embeddable_fields[serializer_class] = self.build_embeddable_fields()
+        return {
+            name: copy.copy(field) if isinstance(field, EmbeddedFieldMixin)
+            else copy.deepcopy(field)
+            for name, field in _embeddable_fields[serializer_class].items()
+        }
+
+    def build_embeddable_fields(self):
         fields = super(EmbeddableModelSerializer, self).get_fields()
+        writable = getattr(self.Meta, "embedded_writable_fields", ())
         for name, field in fields.items():
             if isinstance(field, serializers.PrimaryKeyRelatedField):
                 fields[name] = EmbeddedModelField(
-                    *field._args, **field._kwargs
+                    *field._args, embed_writable=name in writable,
+                    **field._kwargs
                 )
             elif isinstance(field, serializers.ManyRelatedField):
                 kws = field._kwargs
 
                 relation = kws.pop("child_relation")
                 child_relation = EmbeddedModelField(
-                    *relation._args, **relation._kwargs
+                    *relation._args, embed_writable=name in writable,
+                    **relation._kwargs
                 )
 
                 list_kwargs = {'child_relation': child_relation}
@@ -31,8 +81,126 @@ class EmbeddableModelSerializer(
                         list_kwargs[key] = kws[key]
                 fields[name] = EmbeddedManyRelatedField(**list_kwargs)
 
+        fields.update(self.build_reverse_relation_fields())
         return fields
 
+    def build_reverse_relation_fields(self):
+        """
+        Builds the fields of the reverse relations listed in the
+        Meta.embedded_reverse_relations option, either a list of their
+        accessor names or a dict of accessor names to the field kwargs, e.g.
+        {"childmodel_set": {"limit": 5, "ordering": ["-id"]}}.
+        """
+        relations = getattr(self.Meta, "embedded_reverse_relations", None)
+        if not relations:
+            return {}
+        if not isinstance(relations, dict):
+            relations = {name: {} for name in relations}
+        return {
+            name: EmbeddedReverseRelatedField(**kwargs)
+            for name, kwargs in relations.items()
+        }
+
+    @contextmanager
+    def write_embedded(self, validated_data):
+        """
+        Saves the embedded objects written through the fields of the
+        validated data in bulk, in a transaction wrapping the block.
+        """
+        levels = get_embedded_writes(validated_data)
+        if not levels:
+            yield
+            return
+        with transaction.atomic(using=router.db_for_write(self.Meta.model)):
+            save_embedded_writes(levels)
+            yield
+
+    def create(self, validated_data):
+        with self.write_embedded(validated_data):
+            return super(EmbeddableModelSerializer, self).create(
+                validated_data
+            )
+
+    def update(self, instance, validated_data):
+        with self.write_embedded(validated_data):
+            return super(EmbeddableModelSerializer, self).update(
+                instance, validated_data
+            )
+
+    def uses_bulk_create(self):
+        """
+        Returns whether the lists of this serializer are created with
+        create_many. It is opted in by the Meta.embedded_bulk_create option,
+        defaulting to whether Meta.embedded_writable_fields is declared.
+        """
+        return getattr(self.Meta, "embedded_bulk_create", bool(
+            getattr(self.Meta, "embedded_writable_fields", None)
+        ))
+
+    def create_many(self, validated_data):
+        """
+        Creates the instances of a list together with their embedded
+        objects in one transaction, inserting the new instances of each
+        model with a single bulk_create. Bulk inserts skip the save method
+        and the signals of the models, so it is only used when
+        uses_bulk_create is true.
+
+        When create is overridden, it is called for each instance after the
+        embedded objects are saved in bulk.
+        """
+        if type(self).create is not EmbeddableModelSerializer.create:
+            with self.write_embedded(validated_data):
+                return [self.create(attrs) for attrs in validated_data]
+
+        model = self.Meta.model
+        instances = []
+        for attrs in validated_data:
+            raise_errors_on_nested_writes("create", self, attrs)
+            instances.append(build_embedded_instance(model, attrs))
+        with transaction.atomic(using=router.db_for_write(model)):
+            save_embedded_writes(get_embedded_writes(instances))
+        return instances
+
+
+_default_embedded_serializers = {}
+
+
+def get_default_embedded_serializer_class(model):
+    """
+    Returns the serializer class used to embed the given model when no
+    embed_serializer_class is set. Classes are built once per model and kept
+    in a process-wide registry.
+    """
+    try:
+        return _default_embedded_serializers[model]
+    except KeyError:
+        pass
+
+    serializer_class = type(
+        "DefaultEmbeddedSerializer",
+        (EmbeddableModelSerializer,),
+        {
+            'Meta': type(
+                'Meta', (), {
+                    'model': model,
+                    'fields': '__all__'
+                }
+            )
+        }
+    )
+    return _default_embedded_serializers.setdefault(model, serializer_class)
+
+
+def build_default_embedded_serializers(models=None):
+    """
+    Fills the default embedded serializer registry for the given models, or
+    for every installed model.
+    """
+    if models is None:
+        models = apps.get_models()
+    for model in models:
+        get_default_embedded_serializer_class(model)
+
 
 def embedded_field_factory(field, embedded_field_class=EmbeddedField):
     """
@@ -49,41 +217,427 @@ def embedded_field_factory(field, embedded_field_class=EmbeddedField):
 
 
 class EmbeddedModelField(EmbeddedField, serializers.PrimaryKeyRelatedField):
+    render_cache_timeout = None
+    embed_writable = False
+
+    def __init__(self, *args, render_cache_timeout=None, embed_writable=False,
+                 **kwargs):
+        super(EmbeddedModelField, self).__init__(*args, **kwargs)
+        if render_cache_timeout is not None:
+            self.render_cache_timeout = render_cache_timeout
+        self.embed_writable = embed_writable
+        self.embedded_instances = {}
+        self.embedded_values = {}
+
+    def __copy__(self):
+        field = super(EmbeddedModelField, self).__copy__()
+        field.embedded_instances = {}
+        field.embedded_values = {}
+        return field
+
+    def clear_embedded(self):
+        super(EmbeddedModelField, self).clear_embedded()
+        self.embedded_instances.clear()
+        self.embedded_values.clear()
+
     def get_embed_serializer_class(self):
-        model = self.get_queryset().model
-        return type(
-            "DefaultEmbeddedSerializer",
-            (EmbeddableModelSerializer,),
-            {
-                'Meta': type(
-                    'Meta', (), {
-                        'model': model,
-                        'fields': '__all__'
-                    }
-                )
+        return get_default_embedded_serializer_class(
+            self.get_queryset().model
+        )
+
+    def get_attribute(self, instance):
+        """
+        When embedding, returns the related instance if it was already loaded
+        (e.g. by select_related or prefetch_related), avoiding a new query
+        for it. Otherwise falls back to the pk only optimization.
+        """
+        if self.embed and self.source_attrs:
+            try:
+                owner = get_attribute(instance, self.source_attrs[:-1])
+                model_field = owner._meta.get_field(self.source_attrs[-1])
+                is_cached = getattr(model_field, "is_cached", None)
+                if is_cached is not None and is_cached(owner):
+                    return model_field.get_cached_value(owner)
+            except (AttributeError, KeyError, FieldDoesNotExist):
+                pass
+        return super(EmbeddedModelField, self).get_attribute(instance)
+
+    def get_embed_value(self, value):
+        if isinstance(value, models.Model):
+            return value
+        return super(EmbeddedModelField, self).get_embed_value(value)
+
+    def get_embed_cost(self, rows, instances=None):
+        if not rows:
+            return 0, 0
+        queries, requests = 0, 0
+        serializer = self.get_serializer(None, self.embed_relations)
+        if hasattr(serializer, "get_embed_cost"):
+            queries, requests = serializer.get_embed_cost(rows)
+        return queries + 1, requests
+
+    def prefetch_embedded(self, instances):
+        """
+        Loads the related instances of all given instances with a single
+        query, skipping the ones already loaded, and lets the embedded
+        serializer prefetch its own embedded fields for them.
+        """
+        pks, related = set(), {}
+        for instance in instances:
+            try:
+                value = self.get_attribute(instance)
+            except (SkipField, ObjectDoesNotExist, AttributeError, KeyError):
+                continue
+            if isinstance(value, models.Model):
+                related[value.pk] = value
+            elif isinstance(value, PKOnlyObject) and value.pk is not None:
+                pks.add(value.pk)
+        self.load_embedded(pks, related)
+
+    def get_queryset(self):
+        return self.route_queryset(
+            super(EmbeddedModelField, self).get_queryset()
+        )
+
+    def get_render_cache_timeout(self):
+        if self.render_cache_timeout is not None:
+            return self.render_cache_timeout
+        return get_setting("RENDER_CACHE_TIMEOUT")
+
+    def get_render_variant(self, serializer, embedded_models=None):
+        """
+        Returns the render cache variant of the embedded serializer.
+        """
+        if embedded_models is None:
+            embedded_models = get_embedded_models(serializer)
+        return get_render_variant(
+            serializer, self.embed_relations, self.embed_fieldsets,
+            embedded_models
+        )
+
+    def load_embedded(self, pks, related=None):
+        """
+        Loads the instances of the given pks that are not loaded yet with a
+        single query, and lets the embedded serializer prefetch its own
+        embedded fields for them and the related instances given.
+
+        When the render cache is enabled, the cached representations are
+        retrieved first with a single get_many, and the ones missing are
+        rendered and cached. The invalidation of every model rendered must
+        be connected.
+        """
+        related = dict(related or {})
+        serializer = self.get_serializer(None, self.embed_relations)
+        queryset = self.get_queryset()
+        cache_timeout = self.get_render_cache_timeout()
+        if cache_timeout is not None:
+            embedded_models = get_embedded_models(serializer)
+            check_render_invalidation(
+                {queryset.model}.union(embedded_models)
+            )
+            variant = self.get_render_variant(serializer, embedded_models)
+            cached, versions = get_cached_renders(
+                queryset.model, set(pks).union(related).difference(
+                    self.embedded_values
+                ), variant
+            )
+            self.embedded_values.update(cached)
+            related = {
+                pk: instance for pk, instance in related.items()
+                if pk not in self.embedded_values
             }
+            rendered = set(self.embedded_values)
+
+        missing = set(pks).difference(
+            self.embedded_instances, self.embedded_values
+        )
+        converters = get_values_converters(serializer, queryset.model)
+        if missing and converters is not None:
+            self.embedded_values.update(
+                load_values(queryset, missing, converters)
+            )
+        elif missing:
+            if self.get_sparse_fields() is not None:
+                columns = get_serializer_columns(serializer, queryset.model)
+                if columns is not None:
+                    queryset = queryset.only(*columns)
+            self.embedded_instances.update(queryset.in_bulk(missing))
+        for pk in pks:
+            if pk in self.embedded_instances:
+                related.setdefault(pk, self.embedded_instances[pk])
+
+        if related and hasattr(serializer, "prefetch_embedded"):
+            serializer.prefetch_embedded(list(related.values()))
+
+        if cache_timeout is not None:
+            for pk, instance in related.items():
+                self.embedded_values[pk] = serializer.to_representation(
+                    instance
+                )
+            set_cached_renders(queryset.model, {
+                pk: data for pk, data in self.embedded_values.items()
+                if pk not in rendered
+            }, variant, cache_timeout, versions)
+
+    def to_representation(self, value):
+        """
+        Renders the embedded content loaded by the values() fast path
+        directly, otherwise embeds the value through the serializer.
+        """
+        if self.embed and isinstance(value, (PKOnlyObject, models.Model)) \
+                and value.pk in self.embedded_values:
+            with self.measure_embed():
+                return dict(self.embedded_values[value.pk])
+        return super(EmbeddedModelField, self).to_representation(value)
+
+    def get_preloaded(self):
+        """
+        Returns the instances preloaded for the model of this field, keyed by
+        pk and None for the pks that do not exist. They are shared through
+        the context by the serializers validating the request data, so the
+        objects of the request updating a pk update the same instance.
+        """
+        queryset = self.get_queryset()
+        try:
+            query = str(queryset.query)
+        except EmptyResultSet:
+            query = None
+        return self.context.setdefault("embed_preloaded", {}).setdefault(
+            (queryset.model, queryset.db, query), {}
+        )
+
+    def get_preload_key(self, value):
+        if value is None or isinstance(value, (bool, Mapping, list)):
+            return None
+        try:
+            return self.get_queryset().model._meta.pk.to_python(value)
+        except (TypeError, ValueError, DjangoValidationError):
+            return None
+
+    def preload_internal_values(self, values):
+        """
+        Loads the instances of the pks given as input values, and of the
+        embedded objects with a pk, with a single query, so they are not
+        queried one by one while validating. The embedded serializer preloads
+        the instances referenced by the embedded objects.
+        """
+        if self.pk_field is not None:
+            return
+        model = self.get_queryset().model
+        pks, objects = set(), []
+        for value in values:
+            if isinstance(value, Mapping):
+                if not self.embed_writable:
+                    continue
+                objects.append(value)
+                value = value.get(model._meta.pk.name)
+            pk = self.get_preload_key(value)
+            if pk is not None:
+                pks.add(pk)
+
+        preloaded = self.get_preloaded()
+        missing = pks.difference(preloaded)
+        if missing:
+            preloaded.update(dict.fromkeys(missing))
+            preloaded.update(self.get_queryset().in_bulk(missing))
+        if objects:
+            serializer = self.build_serializer(())
+            if hasattr(serializer, "preload_internal_values"):
+                serializer.preload_internal_values(objects)
+
+    def get_internal_instance(self, data):
+        """
+        Returns the instance of the pk given as input, from the preloaded
+        ones when possible.
+        """
+        key = self.get_preload_key(data)
+        preloaded = self.get_preloaded()
+        if self.pk_field is None and key is not None and key in preloaded:
+            if preloaded[key] is None:
+                self.fail("does_not_exist", pk_value=data)
+            return preloaded[key]
+        instance = super(EmbeddedModelField, self).to_internal_value(data)
+        if self.pk_field is None and key is not None:
+            preloaded[key] = instance
+        return instance
+
+    def to_internal_value(self, data):
+        """
+        With embed_writable, the embedded object is also accepted and
+        validated by the embedded serializer: a new instance is built when
+        it has no pk, otherwise the instance of its pk is updated. They are
+        saved in bulk by the serializer.
+        """
+        if not self.embed_writable or not isinstance(data, Mapping):
+            return self.get_internal_instance(data)
+        model = self.get_queryset().model
+        pk = data.get(model._meta.pk.name)
+        instance = None
+        if pk is not None:
+            instance = self.get_internal_instance(pk)
+        serializer = self.build_serializer(
+            (), instance=instance, data=data, partial=instance is not None
+        )
+        serializer.is_valid(raise_exception=True)
+        return build_embedded_instance(
+            model, serializer.validated_data, instance
         )
 
     def to_embedded_representation(self, value, embed_relations):
+        if isinstance(value, models.Model):
+            return value
+        if value in self.embedded_instances:
+            return self.embedded_instances[value]
         return super().to_internal_value(value)
 
 
 class EmbeddedManyRelatedField(EmbeddedFieldMixin, serializers.ManyRelatedField):
     def __init__(self, *args, embed=False, embed_relations=None,
-                 embed_serializer_class=None, **kwargs):
+                 embed_serializer_class=None, embed_using=None, **kwargs):
         super(EmbeddedManyRelatedField, self).__init__(*args, **kwargs)
         self.embed_serializer_class = embed_serializer_class
-        self.embed_relations = embed_relations or []
+        self.embed_using = embed_using
+        self.embed_relations = compile_embed_tree(embed_relations)
         self.embed = embed
+        self.embed_serializers = {}
+        self.embedded_relations = {}
 
-    def to_embedded_representation(self, iterable, embed_relations):
+    def __copy__(self):
+        field = super(EmbeddedManyRelatedField, self).__copy__()
+        field.child_relation = copy.copy(self.child_relation)
+        field.child_relation.parent = field
+        field.embedded_relations = {}
+        return field
+
+    def clear_embedded(self):
+        super(EmbeddedManyRelatedField, self).clear_embedded()
+        self.child_relation.clear_embedded()
+        self.embedded_relations.clear()
+
+    def get_model_field(self, model):
+        """
+        Returns the ManyToManyField this field reads from the model, or None
+        when it is not a forward many to many relation of it.
+        """
+        if len(self.source_attrs) != 1:
+            return None
+        try:
+            model_field = model._meta.get_field(self.source_attrs[0])
+        except (AttributeError, FieldDoesNotExist):
+            return None
+        if isinstance(model_field, models.ManyToManyField):
+            return model_field
+        return None
 
+    def get_attribute(self, instance):
+        """
+        When embedding, returns the related instances loaded in bulk by
+        prefetch_embedded instead of querying them for each instance.
+        """
+        if self.embed and getattr(instance, "pk", None) in \
+                self.embedded_relations:
+            related = self.child_relation.embedded_instances
+            values = self.child_relation.embedded_values
+            return [
+                related[pk] if pk in related else PKOnlyObject(pk=pk)
+                for pk in self.embedded_relations[instance.pk]
+                if pk in related or pk in values
+            ]
+        return super(EmbeddedManyRelatedField, self).get_attribute(instance)
+
+    def prefetch_embedded(self, instances):
+        """
+        Loads the through table rows of all given instances with one query
+        and their distinct related instances with another one, skipping the
+        instances whose relation was already prefetched.
+        """
+        if not instances:
+            return
+        model_field = self.get_model_field(type(instances[0]))
+        if model_field is None:
+            return
+        pks = {
+            instance.pk for instance in instances
+            if instance.pk is not None and
+            instance.pk not in self.embedded_relations and
+            model_field.name not in getattr(
+                instance, "_prefetched_objects_cache", {}
+            )
+        }
+        if not pks:
+            return
+
+        through = model_field.remote_field.through
+        source = model_field.m2m_field_name()
+        target = model_field.m2m_reverse_field_name()
+        # Ordering by the target relation follows the ordering of the related
+        # model, like the related manager does.
+        ordering = (target, "pk") \
+            if model_field.related_model._meta.ordering else ("pk",)
+        self.setup_child_relation(self.embed_relations)
+        rows = self.child_relation.route_queryset(
+            through._default_manager.filter(**{source + "__in": pks})
+        ).order_by(*ordering).values_list(
+            through._meta.get_field(source).attname,
+            through._meta.get_field(target).attname,
+        )
+        relations = {pk: [] for pk in pks}
+        for source_pk, target_pk in rows:
+            relations[source_pk].append(target_pk)
+
+        self.child_relation.load_embedded({
+            target_pk for target_pks in relations.values()
+            for target_pk in target_pks
+        })
+        self.embedded_relations.update(relations)
+
+    def preload_internal_values(self, values):
+        self.child_relation.preload_internal_values([
+            item for value in values if isinstance(value, (list, tuple))
+            for item in value
+        ])
+
+    def setup_child_relation(self, embed_relations):
         self.child_relation.embed = True
+        if self.embed_using is not None:
+            self.child_relation.embed_using = self.embed_using
         self.child_relation.embed_relations = embed_relations
+        self.child_relation.embed_fieldsets = self.embed_fieldsets
+
+    def get_embedded_serializer(self):
+        self.setup_child_relation(self.embed_relations)
+        return self.child_relation.get_embedded_serializer()
+
+    def get_embed_cost(self, rows, instances=None):
+        """
+        The through table rows and the related objects of all rows are
+        queried once for many to many fields, otherwise the related objects
+        of each row are queried on their own. Each row is assumed to have
+        EMBED_MANY_FANOUT of them.
+        """
+        if not rows:
+            return 0, 0
+        model = getattr(getattr(self.parent, "Meta", None), "model", None)
+        queries = 2 if self.get_model_field(model) is not None else rows
+        requests = 0
+        self.setup_child_relation(self.embed_relations)
+        serializer = self.child_relation.get_serializer(
+            None, self.embed_relations
+        )
+        if hasattr(serializer, "get_embed_cost"):
+            nested_queries, requests = serializer.get_embed_cost(
+                rows * get_setting("EMBED_MANY_FANOUT")
+            )
+            queries += nested_queries
+        return queries, requests
+
+    def to_embedded_representation(self, iterable, embed_relations):
+        self.setup_child_relation(embed_relations)
         reprs = []
-        for value in iterable:
-            repr = self.child_relation.to_representation(value)
-            reprs.append(repr)
+        with self.measure_embed():
+            for value in iterable:
+                repr = self.child_relation.to_representation(value)
+                reprs.append(repr)
         return reprs
     
     def to_representation(self, value):
@@ -93,3 +647,313 @@ class EmbeddedManyRelatedField(EmbeddedFieldMixin, serializers.ManyRelatedField)
             )
             return embedded_value
         return super(EmbeddedManyRelatedField, self).to_representation(value)
+
+
+class EmbeddedReverseRelatedField(EmbeddedFieldMixin, serializers.Field):
+    """
+    Read only field of a reverse foreign key relation (e.g. childmodel_set),
+    only rendered when embedded.
+
+    The related instances of all rows of a list are loaded with a single
+    query, sorted by ordering (defaulting to the related model ordering or
+    pk). When limit is given, only the first limit related instances of each
+    row are loaded, which are selected in the database with a window
+    function. Before Django 4.2, all of them are loaded and the limit is
+    applied in Python.
+    """
+
+    def __init__(self, *args, embed=False, embed_relations=None,
+                 embed_serializer_class=None, embed_using=None, limit=None,
+                 ordering=None, **kwargs):
+        kwargs["read_only"] = True
+        super(EmbeddedReverseRelatedField, self).__init__(*args, **kwargs)
+        self.embed_serializer_class = embed_serializer_class
+        self.embed_using = embed_using
+        self.embed_relations = compile_embed_tree(embed_relations)
+        self.embed = embed
+        self.limit = limit
+        self.ordering = list(ordering or [])
+        self.embed_serializers = {}
+        self.embedded_relations = {}
+        assert limit is None or limit > 0, "limit must be a positive integer"
+
+    def __copy__(self):
+        field = super(EmbeddedReverseRelatedField, self).__copy__()
+        field.embedded_relations = {}
+        return field
+
+    def clear_embedded(self):
+        super(EmbeddedReverseRelatedField, self).clear_embedded()
+        self.embedded_relations.clear()
+
+    def get_relation(self, model):
+        """
+        Returns the ManyToOneRel whose accessor is the source of this field.
+        """
+        for relation in model._meta.related_objects:
+            if relation.one_to_many and \
+                    relation.get_accessor_name() == self.source:
+                return relation
+        raise ImproperlyConfigured(
+            "{} has no reverse foreign key relation named {}.".format(
+                model.__name__, self.source
+            )
+        )
+
+    def get_model(self):
+        return self.parent.Meta.model
+
+    def get_embed_serializer_class(self):
+        return self.embed_serializer_class or \
+            get_default_embedded_serializer_class(
+                self.get_relation(self.get_model()).related_model
+            )
+
+    def get_queryset(self, pks):
+        """
+        Returns the related instances of the given pks, limited to the first
+        limit of each one when set, ordered by the relation column.
+        """
+        relation = self.get_relation(self.get_model())
+        column = relation.field.attname
+        queryset = self.route_queryset(
+            relation.related_model._default_manager.filter(
+                **{relation.field.name + "__in": pks}
+            )
+        )
+        if self.get_sparse_fields() is not None:
+            columns = get_serializer_columns(
+                self.get_serializer(None, self.embed_relations),
+                relation.related_model
+            )
+            if columns is not None:
+                queryset = queryset.only(relation.field.name, *columns)
+        opts = relation.related_model._meta
+        ordering = self.ordering or list(opts.ordering) or [opts.pk.name]
+        if self.limit is not None and WINDOW_FILTERS:
+            queryset = queryset.annotate(embed_row_number=Window(
+                RowNumber(), partition_by=[F(column)], order_by=ordering
+            )).filter(embed_row_number__lte=self.limit)
+        return queryset.order_by(column, *ordering)
+
+    def get_attribute(self, instance):
+        if not self.embed:
+            raise SkipField()
+        if instance.pk in self.embedded_relations:
+            return self.embedded_relations[instance.pk]
+        queryset = self.get_queryset([instance.pk])
+        if self.limit is not None:
+            queryset = queryset[:self.limit]
+        return list(queryset)
+
+    def get_embed_cost(self, rows, instances=None):
+        if not rows:
+            return 0, 0
+        queries, requests = 1, 0
+        serializer = self.get_serializer(None, self.embed_relations)
+        if hasattr(serializer, "get_embed_cost"):
+            nested_queries, requests = serializer.get_embed_cost(
+                rows * (self.limit or get_setting("EMBED_MANY_FANOUT"))
+            )
+            queries += nested_queries
+        return queries, requests
+
+    def prefetch_embedded(self, instances):
+        pks = {
+            instance.pk for instance in instances
+            if instance.pk is not None and
+            instance.pk not in self.embedded_relations
+        }
+        if not pks:
+            return
+        relations = {pk: [] for pk in pks}
+        column = self.get_relation(self.get_model()).field.attname
+        related = []
+        for instance in self.get_queryset(pks):
+            rows = relations[getattr(instance, column)]
+            if self.limit is None or len(rows) < self.limit:
+                rows.append(instance)
+                related.append(instance)
+        self.embedded_relations.update(relations)
+
+        serializer = self.get_serializer(None, self.embed_relations)
+        if related and hasattr(serializer, "prefetch_embedded"):
+            serializer.prefetch_embedded(related)
+
+    def to_embedded_representation(self, value, embed_relations):
+        return value
+
+    def to_representation(self, value):
+        with self.measure_embed():
+            serializer = self.get_serializer(None, self.embed_relations)
+            return [serializer.to_representation(item) for item in value]
+
+
+def get_related_model(model, source_attrs):
+    """
+    Follows the source_attrs through the model relations, returning the last
+    related model or None if any of them is not a relation.
+    """
+    for attr in source_attrs:
+        try:
+            model_field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+        if not model_field.is_relation or model_field.related_model is None:
+            return None
+        model = model_field.related_model
+    return model
+
+
+def get_serializer_columns(serializer, model):
+    """
+    Returns the names of the model fields read by the serializer fields, or
+    None if any of them is not read from a concrete model field.
+    """
+    columns = {model._meta.pk.name}
+    for field in serializer.fields.values():
+        if len(field.source_attrs) != 1:
+            return None
+        try:
+            model_field = model._meta.get_field(field.source_attrs[0])
+        except FieldDoesNotExist:
+            return None
+        if not model_field.concrete or model_field.many_to_many:
+            return None
+        columns.add(model_field.name)
+    return columns
+
+
+def get_embedded_models(serializer):
+    """
+    Returns the models of the serializers embedded in the given one, at any
+    depth.
+    """
+    embedded_models = set()
+    for field in serializer.fields.values():
+        if not getattr(field, "embed", False) or \
+                not hasattr(field, "get_embedded_serializer"):
+            continue
+        nested = field.get_embedded_serializer()
+        if isinstance(nested, serializers.ModelSerializer):
+            embedded_models.add(nested.Meta.model)
+            embedded_models.update(get_embedded_models(nested))
+    return embedded_models
+
+
+def get_values_converters(serializer, model):
+    """
+    Returns the (field name, column, converter) of each field of a default
+    embedded serializer when all of them render plain model columns,
+    allowing its content to be loaded with values() instead of model
+    instances. Returns None otherwise.
+    """
+    if _default_embedded_serializers.get(model) is not type(serializer):
+        return None
+    converters = []
+    for field in serializer._readable_fields:
+        if getattr(field, "embed", False) or len(field.source_attrs) != 1:
+            return None
+        try:
+            model_field = model._meta.get_field(field.source_attrs[0])
+        except FieldDoesNotExist:
+            return None
+        if not model_field.concrete or model_field.many_to_many or \
+                isinstance(model_field, models.FileField):
+            return None
+        if isinstance(field, serializers.PrimaryKeyRelatedField):
+            convert = field.pk_field.to_representation if field.pk_field \
+                else None
+        elif isinstance(field, (
+            serializers.RelatedField, serializers.ModelField
+        )) or type(field).get_attribute is not serializers.Field.get_attribute:
+            # These read something else than the column value.
+            return None
+        else:
+            convert = field.to_representation
+        converters.append((field.field_name, model_field.attname, convert))
+    return converters
+
+
+def load_values(queryset, pks, converters):
+    """
+    Returns the representation of the instances of the given pks, built
+    from values() rows with the converters of get_values_converters.
+    """
+    pk_name = queryset.model._meta.pk.attname
+    columns = {pk_name}.union(column for _, column, _ in converters)
+    batch_size = connections[queryset.db].features.max_query_params or \
+        len(pks)
+    pks = list(pks)
+    values = {}
+    for start in range(0, len(pks), batch_size):
+        rows = queryset.filter(
+            pk__in=pks[start:start + batch_size]
+        ).values(*columns)
+        for row in rows:
+            values[row[pk_name]] = {
+                name: row[column] if convert is None or row[column] is None
+                else convert(row[column])
+                for name, column, convert in converters
+            }
+    return values
+
+
+def get_embed_lookups(serializer, model, prefix="", prefetch=False):
+    """
+    Walks the embedded fields of a serializer and returns the select_related
+    and prefetch_related lookups required to load all embedded model
+    instances together with the given model queryset, plus the columns of
+    the selected related models that can be deferred because they are not
+    in the requested sparse fieldsets.
+
+    :param serializers.Serializer serializer: The serializer with the embed
+    fields already set.
+    :param model: The model class the serializer represents.
+    :param str prefix: Lookup prefix of the serializer model.
+    :param bool prefetch: Whether the serializer model is already reached
+    through a prefetch, in which case all lookups must also be prefetched.
+    :return tuple: (select_related lookups, prefetch_related lookups,
+    deferred fields)
+    """
+    select_related, prefetch_related, deferred = [], [], []
+    for field in serializer.fields.values():
+        if not getattr(field, "embed", False) or field.source == "*":
+            continue
+
+        if isinstance(field, EmbeddedModelField):
+            embed_field, many = field, prefetch
+        elif isinstance(field, EmbeddedManyRelatedField):
+            field.setup_child_relation(field.embed_relations)
+            embed_field, many = field.child_relation, True
+        else:
+            continue
+
+        related_model = get_related_model(model, field.source_attrs)
+        if related_model is None:
+            continue
+
+        lookup = prefix + "__".join(field.source_attrs)
+        (prefetch_related if many else select_related).append(lookup)
+
+        nested = embed_field.get_serializer(None, field.embed_relations)
+        if not isinstance(nested, serializers.Serializer):
+            continue
+
+        if not many and embed_field.get_sparse_fields() is not None:
+            columns = get_serializer_columns(nested, related_model)
+            if columns is not None:
+                deferred.extend(
+                    lookup + "__" + model_field.name
+                    for model_field in related_model._meta.concrete_fields
+                    if model_field.name not in columns
+                )
+
+        nested_select, nested_prefetch, nested_deferred = get_embed_lookups(
+            nested, related_model, prefix=lookup + "__", prefetch=many
+        )
+        select_related.extend(nested_select)
+        prefetch_related.extend(nested_prefetch)
+        deferred.extend(nested_deferred)
+
+    return select_related, prefetch_related, deferred
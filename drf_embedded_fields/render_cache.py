@@ -0,0 +1,203 @@
+import hashlib
+
+from django.apps import apps
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from drf_embedded_fields.settings import get_setting
+
+RENDER_CACHE_PREFIX = "drf_embedded_fields:render:"
+
+_connected_models = set()
+
+
+def get_render_cache():
+    return caches[get_setting("CACHE_ALIAS")]
+
+
+def get_model_label(model):
+    return model._meta.label_lower
+
+
+def get_entry_key(model, pk, variant):
+    return "{}{}:{}:{}".format(
+        RENDER_CACHE_PREFIX, get_model_label(model), pk, variant
+    )
+
+
+def get_version_key(model, pk):
+    return "{}{}:{}:version".format(
+        RENDER_CACHE_PREFIX, get_model_label(model), pk
+    )
+
+
+def get_generation_key(model):
+    return "{}{}:generation".format(
+        RENDER_CACHE_PREFIX, get_model_label(model)
+    )
+
+
+def increment(cache, key):
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def get_render_variant(serializer, embed_tree, fieldsets, dependencies=()):
+    """
+    Returns the digest identifying how the instances are rendered: the
+    serializer class, the embed tree and the sparse fieldsets, plus the
+    generations of the models embedded in them so their changes also
+    invalidate the entries.
+    """
+    generations = {}
+    if dependencies:
+        cache = get_render_cache()
+        found = cache.get_many([
+            get_generation_key(model) for model in dependencies
+        ])
+        generations = {
+            get_model_label(model): found.get(get_generation_key(model), 0)
+            for model in dependencies
+        }
+    serializer_class = type(serializer)
+    return hashlib.sha256(repr((
+        serializer_class.__module__ + "." + serializer_class.__qualname__,
+        sorted(embed_tree.paths()),
+        sorted((path, tuple(fields)) for path, fields in fieldsets.items()),
+        sorted(generations.items()),
+    )).encode()).hexdigest()
+
+
+def get_cached_renders(model, pks, variant):
+    """
+    Returns the cached representations of the given pks, keyed by pk, and
+    the current versions of all of them, which set_cached_renders stores
+    with the new entries. Entries stored with an older version are stale.
+    """
+    cache = get_render_cache()
+    entry_keys = {get_entry_key(model, pk, variant): pk for pk in pks}
+    version_keys = {get_version_key(model, pk): pk for pk in pks}
+    found = cache.get_many(list(entry_keys) + list(version_keys))
+    versions = {
+        pk: found.get(key, 0) for key, pk in version_keys.items()
+    }
+    renders = {}
+    for key, pk in entry_keys.items():
+        if key in found and found[key][0] == versions[pk]:
+            renders[pk] = found[key][1]
+    return renders, versions
+
+
+def set_cached_renders(model, renders, variant, timeout, versions):
+    get_render_cache().set_many({
+        get_entry_key(model, pk, variant): (versions.get(pk, 0), data)
+        for pk, data in renders.items()
+    }, timeout)
+
+
+def invalidate_renders(model, pks):
+    """
+    Bumps the versions of the given pks, so their cached representations
+    are stale in every variant, and the generation of the model,
+    invalidating the entries of other models embedding it. Both use the
+    atomic incr of the cache, so concurrent invalidations are not lost.
+    """
+    cache = get_render_cache()
+    for pk in pks:
+        increment(cache, get_version_key(model, pk))
+    increment(cache, get_generation_key(model))
+
+
+def invalidate_bulk_renders(model, pks):
+    """
+    Invalidates the instances written in bulk, which send no model signals,
+    when the invalidation of the model is connected.
+    """
+    if get_model_label(model) in _connected_models:
+        invalidate_renders(model, pks)
+
+
+def _invalidate_instance(sender, instance, **kwargs):
+    invalidate_renders(sender, [instance.pk])
+
+
+def _invalidate_m2m(sender, instance, action, reverse, model, pk_set,
+                    **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if get_model_label(type(instance)) in _connected_models:
+        invalidate_renders(type(instance), [instance.pk])
+    if get_model_label(model) in _connected_models:
+        invalidate_renders(model, pk_set or ())
+
+
+def connect_invalidation(model):
+    label = get_model_label(model)
+    if label in _connected_models:
+        return
+    _connected_models.add(label)
+    uid = RENDER_CACHE_PREFIX + label
+    post_save.connect(
+        _invalidate_instance, sender=model, weak=False, dispatch_uid=uid
+    )
+    post_delete.connect(
+        _invalidate_instance, sender=model, weak=False, dispatch_uid=uid
+    )
+    through_models = {
+        field.remote_field.through for field in model._meta.many_to_many
+    }.union(
+        relation.through for relation in model._meta.related_objects
+        if relation.many_to_many
+    )
+    for through in through_models:
+        m2m_changed.connect(
+            _invalidate_m2m, sender=through, weak=False,
+            dispatch_uid=RENDER_CACHE_PREFIX + get_model_label(through)
+        )
+
+
+def check_render_invalidation(models):
+    """
+    Raises ImproperlyConfigured when the invalidation of one of the models is
+    not connected, as their cached representations would never be
+    invalidated.
+    """
+    labels = sorted(
+        label for label in map(get_model_label, models)
+        if label not in _connected_models
+    )
+    if labels:
+        raise ImproperlyConfigured(
+            "The render cache invalidation of {} is not connected. Add "
+            "drf_embedded_fields to INSTALLED_APPS with "
+            "RENDER_CACHE_INVALIDATION enabled, or call "
+            "connect_invalidations().".format(", ".join(labels))
+        )
+
+
+def uses_render_invalidation():
+    """
+    Returns whether the invalidation signals are connected at startup, by
+    the RENDER_CACHE_INVALIDATION setting, defaulting to whether
+    RENDER_CACHE_TIMEOUT is set.
+    """
+    enabled = get_setting("RENDER_CACHE_INVALIDATION")
+    if enabled is None:
+        return get_setting("RENDER_CACHE_TIMEOUT") is not None
+    return enabled
+
+
+def connect_invalidations(models=None):
+    """
+    Connects the invalidation signals of the given models, or of every
+    installed model. Every process writing to the models must connect them,
+    which the app config does on startup when uses_render_invalidation.
+    """
+    if models is None:
+        models = apps.get_models()
+    for model in models:
+        connect_invalidation(model)
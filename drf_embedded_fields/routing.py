@@ -0,0 +1,44 @@
+from django.db import router
+from rest_framework.permissions import SAFE_METHODS
+
+from drf_embedded_fields.settings import get_setting
+
+
+def use_primary(request):
+    """
+    Sends the embed queries of the rest of the request to the primary
+    database, e.g. after writing to it in a safe method.
+    """
+    request._embed_use_primary = True
+
+
+def uses_primary(request):
+    """
+    Returns whether the embed queries of the request must be sent to the
+    primary database: when EMBED_STICKY_PRIMARY is set and the request may
+    have written to it.
+    """
+    if request is None or not get_setting("EMBED_STICKY_PRIMARY"):
+        return False
+    return request.method not in SAFE_METHODS or \
+        getattr(request, "_embed_use_primary", False)
+
+
+def route_queryset(queryset, request=None, using=None):
+    """
+    Returns the queryset using the database the embed queries are sent to:
+    the given alias, falling back to EMBED_DATABASE, or the primary one when
+    the request uses it. The special "router" alias asks the database
+    routers with the embedded=True hint. When no alias is configured, the
+    queryset is left as is.
+    """
+    using = using or get_setting("EMBED_DATABASE")
+    if using is None:
+        return queryset
+    if uses_primary(request):
+        return queryset.using(get_setting("EMBED_PRIMARY_DATABASE"))
+    if using == "router":
+        using = router.db_for_read(queryset.model, embedded=True)
+        if using is None:
+            return queryset
+    return queryset.using(using)
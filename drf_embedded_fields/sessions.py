@@ -0,0 +1,58 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def build_session(pool_size, retries, backoff_factor):
+    """
+    Returns a new requests Session with a connection pool of pool_size
+    connections, retrying idempotent methods on connection errors and
+    502/503/504 responses.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url, pool_size, retries, backoff_factor):
+    """
+    Returns the process-wide session used to call the host of the given url,
+    so connections are kept alive and reused between embedded calls.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc, pool_size, retries, backoff_factor)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = build_session(pool_size, retries, backoff_factor)
+                _sessions[key] = session
+    return session
+
+
+def close_sessions():
+    """
+    Closes and forgets all the pooled sessions.
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    # Max threads used to run the API calls of a list concurrently. None
+    # disables concurrent calls.
+    "MAX_WORKERS": None,
+    # Callable, or its dotted path, returning the async context manager HTTP
+    # client used by the async serialization (adata).
+    "ASYNC_CLIENT": "httpx.AsyncClient",
+    # Connection pool size of the session kept for each upstream host.
+    "POOL_SIZE": 10,
+    # Timeouts, in seconds, of the API calls.
+    "CONNECT_TIMEOUT": 5,
+    "READ_TIMEOUT": 30,
+    # Retries of idempotent API calls and the backoff factor between them.
+    "RETRIES": 0,
+    "BACKOFF_FACTOR": 0,
+    # Seconds the API responses are cached for. None disables the cache.
+    "CACHE_TIMEOUT": None,
+    # Seconds an expired response is kept to be revalidated with its ETag.
+    "CACHE_STALE_TIMEOUT": 60 * 60 * 24,
+    # Django cache used to store the API responses.
+    "CACHE_ALIAS": "default",
+    # Renders the upstream content as decoded, skipping the embedded
+    # serializer and only projecting the requested sparse fields.
+    "TRUSTED": False,
+    # Callable, or its dotted path, decoding the upstream JSON bodies (e.g.
+    # "orjson.loads"). None uses the decoder of the HTTP client.
+    "JSON_LOADS": None,
+    # Bytes an upstream response body may have before being aborted. None
+    # disables the limit.
+    "MAX_RESPONSE_SIZE": None,
+    # Failures within CIRCUIT_WINDOW seconds that open the circuit of an
+    # upstream host for CIRCUIT_COOLDOWN seconds. None disables it.
+    "CIRCUIT_FAILURE_THRESHOLD": None,
+    "CIRCUIT_WINDOW": 60,
+    "CIRCUIT_COOLDOWN": 30,
+    # What an API field renders while its circuit is open: "error" raises,
+    # "stale" uses the expired cached response (raising when there is none),
+    # "id" renders the value without embedding and "placeholder" renders
+    # CIRCUIT_PLACEHOLDER.
+    "CIRCUIT_FALLBACK": "error",
+    "CIRCUIT_PLACEHOLDER": {
+        "detail": "The upstream service is temporarily unavailable."
+    },
+    # Limits of the embed querystring. Requests over them are rejected with
+    # 400 before serializing. None disables a limit.
+    "EMBED_MAX_DEPTH": None,
+    "EMBED_MAX_PATHS": None,
+    # Budgets of estimated database queries and API requests per response.
+    "EMBED_MAX_QUERIES": None,
+    "EMBED_MAX_REQUESTS": None,
+    # Related objects per row assumed when estimating many relations costs.
+    "EMBED_MANY_FANOUT": 10,
+    # Database alias the embed queries are sent to, e.g. a read replica.
+    # "router" asks the database routers with the embedded=True hint and
+    # None leaves them on the database of the field queryset.
+    "EMBED_DATABASE": None,
+    # Sends the embed queries of requests with unsafe methods, or marked with
+    # routing.use_primary, to EMBED_PRIMARY_DATABASE. Only applies when an
+    # embed alias is configured, by EMBED_DATABASE or a field embed_using.
+    "EMBED_STICKY_PRIMARY": True,
+    "EMBED_PRIMARY_DATABASE": "default",
+    # Seconds the representations of embedded model instances are cached
+    # for, invalidated when the instances change, which requires the app in
+    # INSTALLED_APPS. None disables the cache.
+    "RENDER_CACHE_TIMEOUT": None,
+    # Connects the signals invalidating the render cache for every model on
+    # startup, which every process writing to the models needs. None enables
+    # it when RENDER_CACHE_TIMEOUT is set, False or True override it, e.g.
+    # when only some fields set a render_cache_timeout.
+    "RENDER_CACHE_INVALIDATION": None,
+    # Rows inserted or updated per statement by the bulk writes of embedded
+    # objects. None writes them all in as few statements as the database
+    # allows.
+    "EMBED_WRITE_BATCH_SIZE": None,
+    # Records the time, queries and upstream calls of each embedded field in
+    # the responses of the views using EmbeddedInstrumentationMixin.
+    "INSTRUMENTATION": False,
+    # Callable, or its dotted path, called with the request and its
+    # EmbedStats after each instrumented response.
+    "INSTRUMENTATION_HOOK": None,
+    # Adds the stats of the instrumented responses as a Server-Timing header.
+    "SERVER_TIMING": False,
+}
+
+
+def get_setting(name):
+    """
+    Returns a setting from the DRF_EMBEDDED_FIELDS dict in the Django
+    settings, falling back to the default value.
+    """
+    user_settings = getattr(settings, "DRF_EMBEDDED_FIELDS", {})
+    return user_settings.get(name, DEFAULTS[name])
+
+
+def get_callable_setting(name):
+    """
+    Returns a setting that may be given as a dotted path, importing it.
+    """
+    value = get_setting(name)
+    if isinstance(value, str):
+        return import_string(value)
+    return value
@@ -0,0 +1,136 @@
+from itertools import chain, islice
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+
+from drf_embedded_fields.instrumentation import start_embed_stats, \
+    report_embed_stats
+from drf_embedded_fields.model_fields import get_embed_lookups
+from drf_embedded_fields.settings import get_setting
+
+
+class EmbeddedQuerySetMixin:
+    """
+    Mixin to be used in GenericAPIView subclasses whose serializer contains
+    embedded model fields.
+
+    It reads the embed fields from the serializer and applies the matching
+    select_related / prefetch_related to the queryset, so the embedded fields
+    use the already loaded instances instead of querying them once per row.
+    Columns left out by the sparse fieldsets of selected relations are
+    deferred.
+    """
+
+    def get_queryset(self):
+        queryset = super(EmbeddedQuerySetMixin, self).get_queryset()
+        select_related, prefetch_related, deferred = get_embed_lookups(
+            self.get_serializer(), queryset.model
+        )
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        if deferred:
+            queryset = queryset.defer(*deferred)
+        return queryset
+
+
+class EmbeddedInstrumentationMixin:
+    """
+    Mixin to be used in APIView subclasses to record the time, database
+    queries and upstream calls of each embedded field, when the
+    INSTRUMENTATION setting is enabled.
+
+    The stats are reported through the embed_stats_collected signal, the
+    INSTRUMENTATION_HOOK and, with SERVER_TIMING, the Server-Timing header.
+    The stats of streaming responses are reported once their content is
+    sent, so they have no Server-Timing header.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super(EmbeddedInstrumentationMixin, self).initial(
+            request, *args, **kwargs
+        )
+        if get_setting("INSTRUMENTATION"):
+            start_embed_stats(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(EmbeddedInstrumentationMixin, self).finalize_response(
+            request, response, *args, **kwargs
+        )
+        if response.streaming:
+            response.streaming_content = self.report_after_stream(
+                request, response.streaming_content
+            )
+        else:
+            report_embed_stats(request, response)
+        return response
+
+    def report_after_stream(self, request, content):
+        try:
+            yield from content
+        finally:
+            report_embed_stats(request)
+
+
+class EmbeddedStreamingMixin:
+    """
+    Mixin to be used in ListModelMixin views to stream unpaginated JSON lists.
+
+    The queryset is iterated in chunks of stream_chunk_size instances, whose
+    embedded content is resolved in bulk and rendered before moving to the
+    next chunk, so the memory used is bounded by the chunk size instead of
+    the number of results. Embed budgets are checked per chunk: the first
+    chunk is rendered before the response is returned, so its rejection is
+    still an error response, while a later one ends the stream.
+    """
+    stream_chunk_size = 1000
+
+    def get_stream_chunk_size(self):
+        return self.stream_chunk_size
+
+    def list(self, request, *args, **kwargs):
+        if self.paginator is not None or not isinstance(
+                request.accepted_renderer, JSONRenderer
+        ):
+            return super(EmbeddedStreamingMixin, self).list(
+                request, *args, **kwargs
+            )
+
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer(queryset, many=True)
+        chunk_size = self.get_stream_chunk_size()
+        items = serializer.iter_representation(queryset, chunk_size)
+        first = list(islice(items, 1))
+        return StreamingHttpResponse(
+            self.stream_json(chain(first, items), chunk_size),
+            content_type=request.accepted_renderer.media_type
+        )
+
+    def stream_json(self, items, chunk_size):
+        renderer = JSONRenderer()
+        yield b"["
+        separator, chunk = b"", []
+        for item in items:
+            chunk.append(renderer.render(item))
+            if len(chunk) == chunk_size:
+                yield separator + b",".join(chunk)
+                separator, chunk = b",", []
+        if chunk:
+            yield separator + b",".join(chunk)
+        yield b"]"
+
+
+class EmbeddedBulkCreateMixin:
+    """
+    Mixin to be used in CreateModelMixin views to accept a list of objects,
+    which the EmbeddableListSerializer creates in bulk together with their
+    embedded objects.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get("data"), list):
+            kwargs.setdefault("many", True)
+        return super(EmbeddedBulkCreateMixin, self).get_serializer(
+            *args, **kwargs
+        )
@@ -0,0 +1,258 @@
+from collections.abc import Mapping
+from itertools import chain
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, models
+from rest_framework import serializers
+from rest_framework.utils import model_meta
+
+from drf_embedded_fields.render_cache import invalidate_bulk_renders
+from drf_embedded_fields.settings import get_setting
+
+
+class EmbeddedWrite:
+    """
+    Write pending on an embedded instance: the fields to update, or None
+    when the instance is created, and the values of its to-many relations,
+    set once every instance is saved.
+    """
+
+    def __init__(self, update_fields=None, many_related=None):
+        self.update_fields = update_fields
+        self.many_related = many_related or {}
+
+
+def build_embedded_instance(model, validated_data, instance=None):
+    """
+    Returns a new instance of the model with the validated data, or the given
+    instance updated with it, marked to be saved by save_embedded_writes.
+    """
+    validated_data = dict(validated_data)
+    info = model_meta.get_field_info(model)
+    many_related = {
+        name: validated_data.pop(name)
+        for name, relation_info in info.relations.items()
+        if relation_info.to_many and name in validated_data
+    }
+    if instance is None:
+        instance = model(**validated_data)
+        instance._embedded_write = EmbeddedWrite(None, many_related)
+        return instance
+    if validated_data or many_related:
+        merge_embedded_write(instance, validated_data, many_related)
+    return instance
+
+
+def merge_embedded_write(instance, values, many_related=None):
+    """
+    Sets the values on the instance and adds them to its pending update, e.g.
+    when several objects of the request update the same instance. Raises a
+    ValidationError when they set a field to different values.
+    """
+    many_related = many_related or {}
+    write = getattr(instance, "_embedded_write", None)
+    if write is None:
+        write = instance._embedded_write = EmbeddedWrite([])
+    conflicts = [
+        name for name, value in values.items()
+        if name in (write.update_fields or ()) and
+        getattr(instance, name) != value
+    ] + [
+        name for name, value in many_related.items()
+        if name in write.many_related and
+        write.many_related[name] != value
+    ]
+    if conflicts:
+        raise serializers.ValidationError({
+            name: ["Conflicts with another update of the same object."]
+            for name in conflicts
+        })
+    for attr, value in values.items():
+        setattr(instance, attr, value)
+    if write.update_fields is not None:
+        write.update_fields = sorted(set(write.update_fields).union(values))
+    write.many_related.update(many_related)
+
+
+def get_embedded_writes(values):
+    """
+    Returns the instances pending a write in the given values (e.g. the
+    validated data of a serializer), at any depth, grouped in levels: the
+    instances of a level only reference instances of the levels before it.
+    Each instance is placed in the last level it can be saved at, so the
+    rows of the same model usually share a level and a single bulk write.
+    """
+    ordered, visited, referrers = [], set(), {}
+
+    def visit(value, referrer=None):
+        if isinstance(value, Mapping):
+            value = list(value.values())
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                visit(item, referrer)
+            return
+        if not isinstance(value, models.Model) or \
+                getattr(value, "_embedded_write", None) is None:
+            return
+        if referrer is not None:
+            referrers.setdefault(id(value), []).append(referrer)
+        if id(value) in visited:
+            return
+        visited.add(id(value))
+        visit([
+            field.get_cached_value(value)
+            for field in value._meta.concrete_fields
+            if field.is_relation and field.is_cached(value)
+        ], referrer=value)
+        visit(list(value._embedded_write.many_related.values()))
+        ordered.append(value)
+
+    visit(values)
+    # Updates of the same row through different instances are merged in the
+    # first one.
+    updated, duplicates = {}, {}
+    for instance in ordered:
+        write = instance._embedded_write
+        if write.update_fields is None:
+            continue
+        key = (type(instance), instance.pk)
+        first = updated.setdefault(key, instance)
+        if first is not instance:
+            merge_embedded_write(first, {
+                name: getattr(instance, name) for name in write.update_fields
+            }, write.many_related)
+            for name in first._embedded_write.update_fields:
+                setattr(instance, name, getattr(first, name))
+            del instance._embedded_write
+            duplicates[id(instance)] = first
+            referrers.setdefault(id(first), []).extend(
+                referrers.pop(id(instance), ())
+            )
+    if duplicates:
+        ordered = [
+            instance for instance in ordered if id(instance) not in duplicates
+        ]
+        referrers = {
+            key: [
+                duplicates.get(id(referrer), referrer)
+                for referrer in instance_referrers
+            ]
+            for key, instance_referrers in referrers.items()
+        }
+    positions = {}
+
+    def position(instance):
+        if id(instance) not in positions:
+            positions[id(instance)] = min((
+                position(referrer)
+                for referrer in referrers.get(id(instance), ())
+            ), default=len(ordered)) - 1
+        return positions[id(instance)]
+
+    levels = {}
+    for instance in ordered:
+        levels.setdefault(position(instance), []).append(instance)
+    return [levels[position] for position in sorted(levels)]
+
+
+def insert_instances(model, instances):
+    """
+    Inserts the instances with bulk_create, or one by one when the database
+    cannot return the pks of a bulk insert or the model inherits from
+    another concrete model.
+    """
+    manager = model._default_manager
+    features = connections[manager.db].features
+    if model._meta.parents or not features.can_return_rows_from_bulk_insert:
+        for instance in instances:
+            instance.save(force_insert=True)
+        return
+    manager.bulk_create(
+        instances, batch_size=get_setting("EMBED_WRITE_BATCH_SIZE")
+    )
+
+
+def get_many_to_many_field(model, name):
+    """
+    Returns the forward ManyToManyField named name whose through model is
+    auto created, so its rows can be inserted in bulk, or None.
+    """
+    try:
+        model_field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if isinstance(model_field, models.ManyToManyField) and \
+            model_field.remote_field.through._meta.auto_created:
+        return model_field
+    return None
+
+
+def save_embedded_writes(levels):
+    """
+    Saves the instances of get_embedded_writes level by level, with one
+    bulk_create per model for the new ones and one bulk_update per model and
+    set of fields for the updated ones. Then the to-many relations of the new
+    instances are inserted with one bulk_create per through model, while the
+    ones of the updated instances are set one by one.
+
+    Bulk writes send no model signals, so the render cache entries of the
+    written instances are invalidated here.
+    """
+    batch_size = get_setting("EMBED_WRITE_BATCH_SIZE")
+    for instances in levels:
+        by_model = {}
+        for instance in instances:
+            by_model.setdefault(type(instance), []).append(instance)
+        for model, model_instances in by_model.items():
+            created, updated = [], {}
+            for instance in model_instances:
+                update_fields = instance._embedded_write.update_fields
+                if update_fields is None:
+                    created.append(instance)
+                else:
+                    updated.setdefault(tuple(update_fields), []).append(
+                        instance
+                    )
+            if created:
+                insert_instances(model, created)
+            for fields, field_instances in updated.items():
+                if fields:
+                    model._default_manager.bulk_update(
+                        field_instances, fields, batch_size=batch_size
+                    )
+            invalidate_bulk_renders(
+                model, [instance.pk for instance in model_instances]
+            )
+
+    through_rows = {}
+    for instance in chain.from_iterable(levels):
+        write = instance.__dict__.pop("_embedded_write")
+        for name, values in write.many_related.items():
+            model_field = get_many_to_many_field(type(instance), name)
+            if write.update_fields is not None or model_field is None:
+                getattr(instance, name).set(values)
+                continue
+            through = model_field.remote_field.through
+            source = through._meta.get_field(
+                model_field.m2m_field_name()
+            ).attname
+            target = through._meta.get_field(
+                model_field.m2m_reverse_field_name()
+            ).attname
+            through_rows.setdefault(model_field, []).extend(
+                through(**{source: instance.pk, target: pk})
+                for pk in dict.fromkeys(
+                    getattr(value, "pk", value) for value in values
+                )
+            )
+
+    for model_field, rows in through_rows.items():
+        model_field.remote_field.through._default_manager.bulk_create(
+            rows, batch_size=batch_size
+        )
+        target = model_field.remote_field.through._meta.get_field(
+            model_field.m2m_reverse_field_name()
+        ).attname
+        invalidate_bulk_renders(model_field.related_model, {
+            getattr(row, target) for row in rows
+        })
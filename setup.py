@@ -20,4 +20,7 @@ setuptools.setup(
         "Django>=2.2",
         "djangorestframework>=3.1"
     ],
+    extras_require={
+        "async": ["httpx"],
+    },
 )
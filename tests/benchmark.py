@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Benchmarks the list endpoints of the test app over a generated dataset,
+recording for each combination of endpoint and embed querystring the
+database queries, upstream API calls, wall time and peak memory.
+
+Upstream APIs are served by a local stub server. Results are printed, or
+written with --output, as JSON so they can be compared between versions
+with --compare.
+
+    cd tests && PYTHONPATH=.. python benchmark.py --rows 500 --latency 0.002
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext, \
+    setup_test_environment, teardown_test_environment  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+
+from drf_embedded_fields.api_fields import APIResourceIntField  # noqa: E402
+from drf_embedded_fields.sessions import close_sessions  # noqa: E402
+from test_app import views  # noqa: E402
+from test_app.models import RootModel, ParentModel, ChildModel, \
+    ManyModel  # noqa: E402
+from test_app.serializers import ChildSerializer  # noqa: E402
+from test_app.tests.stub_server import StubServer  # noqa: E402
+
+SCENARIOS = [
+    ("list", []),
+    ("list", ["parent"]),
+    ("list", ["parent.root"]),
+    ("list", ["external_api_field"]),
+    ("list", ["parent.root", "external_api_field"]),
+    ("list_prefetched", ["parent.root"]),
+    ("list_batch", ["external_api_field"]),
+    ("many", ["children"]),
+    ("many", ["children.parent.root"]),
+    ("many_prefetched", ["children.parent.root"]),
+]
+
+
+def build_views(api_url):
+    """
+    Returns the views benchmarked, with the upstream APIs pointed to the
+    stub server.
+    """
+    class BenchChildSerializer(ChildSerializer):
+        external_api_field = APIResourceIntField(
+            url=api_url + "/api/v1/{id}/",
+            included_headers=["Authorization"]
+        )
+
+    class BenchChildBatchSerializer(ChildSerializer):
+        external_api_field = APIResourceIntField(
+            url=api_url + "/api/v1/{id}/",
+            batch_url=api_url + "/api/v1/?id__in={ids}",
+            included_headers=["Authorization"]
+        )
+
+    return {
+        "list": views.ListChildView.as_view(
+            serializer_class=BenchChildSerializer
+        ),
+        "list_prefetched": views.ListChildPrefetchedView.as_view(
+            serializer_class=BenchChildSerializer
+        ),
+        "list_batch": views.ListChildBatchView.as_view(
+            serializer_class=BenchChildBatchSerializer
+        ),
+        "many": views.ListManyView.as_view(),
+        "many_prefetched": views.ListManyPrefetchedView.as_view(),
+    }
+
+
+def create_dataset(rows, parents, externals, many, fanout):
+    root = RootModel.objects.create(name="Root")
+    ParentModel.objects.bulk_create(
+        ParentModel(str_field="Parent {}".format(i), root=root)
+        for i in range(parents)
+    )
+    parent_ids = list(ParentModel.objects.values_list("pk", flat=True))
+    ChildModel.objects.bulk_create(
+        ChildModel(
+            parent_id=parent_ids[i % parents],
+            external_api_field=i % externals + 1
+        )
+        for i in range(rows)
+    )
+    child_ids = list(ChildModel.objects.values_list("pk", flat=True))
+    ManyModel.objects.bulk_create(ManyModel() for _ in range(many))
+    through = ManyModel.children.through
+    through.objects.bulk_create(
+        through(manymodel_id=many_id, childmodel_id=child_ids[
+            (i * fanout + j) % rows
+        ])
+        for i, many_id in enumerate(
+            ManyModel.objects.values_list("pk", flat=True)
+        )
+        for j in range(fanout)
+    )
+
+
+def get_stub_responses(externals):
+    resources = [
+        {"id": i, "field_1": "External {}".format(i)}
+        for i in range(1, externals + 1)
+    ]
+    responses = {
+        "/api/v1/{}/".format(resource["id"]): (200, resource)
+        for resource in resources
+    }
+    responses["/api/v1/"] = (200, resources)
+    return responses
+
+
+def run_scenario(view, stub, path, embed, repeat):
+    factory = APIRequestFactory()
+
+    def call():
+        request = factory.get(path, {"embed": embed})
+        response = view(request)
+        response.render()
+        assert response.status_code == 200, response.content
+        return response
+
+    times = []
+    for _ in range(repeat):
+        upstream = len(stub.requests)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = call()
+            times.append(time.perf_counter() - start)
+        upstream = len(stub.requests) - upstream
+
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "queries": len(queries),
+        "upstream_calls": upstream,
+        "response_bytes": len(response.content),
+        "wall_time_min": min(times),
+        "wall_time_median": statistics.median(times),
+        "peak_memory_bytes": peak,
+    }
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        create_dataset(
+            options.rows, options.parents, options.externals,
+            options.many, options.fanout
+        )
+        with StubServer(
+            get_stub_responses(options.externals), latency=options.latency
+        ) as stub:
+            bench_views = build_views(stub.url)
+            results = []
+            for name, embed in SCENARIOS:
+                path = "/" + name.replace("_", "/") + "/"
+                result = {"endpoint": name, "embed": embed}
+                result.update(run_scenario(
+                    bench_views[name], stub, path, embed, options.repeat
+                ))
+                results.append(result)
+    finally:
+        close_sessions()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    return {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "config": {
+            key: getattr(options, key) for key in (
+                "rows", "parents", "externals", "many", "fanout",
+                "latency", "repeat"
+            )
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    """
+    Prints the change of every measure against a previous report.
+    """
+    previous = {
+        (result["endpoint"], tuple(result["embed"])): result
+        for result in baseline["results"]
+    }
+    for result in report["results"]:
+        key = (result["endpoint"], tuple(result["embed"]))
+        if key not in previous:
+            continue
+        changes = []
+        for measure in ("queries", "upstream_calls", "wall_time_median",
+                        "peak_memory_bytes"):
+            before, after = previous[key][measure], result[measure]
+            if before:
+                changes.append("{} {:+.0%}".format(measure, after / before - 1))
+            else:
+                changes.append("{} {} -> {}".format(measure, before, after))
+        print("{} embed={}: {}".format(
+            key[0], ",".join(key[1]) or "-", ", ".join(changes)
+        ), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=200,
+                        help="Number of ChildModel rows.")
+    parser.add_argument("--parents", type=int, default=20,
+                        help="Number of distinct parents of the children.")
+    parser.add_argument("--externals", type=int, default=20,
+                        help="Number of distinct upstream resources.")
+    parser.add_argument("--many", type=int, default=50,
+                        help="Number of ManyModel rows.")
+    parser.add_argument("--fanout", type=int, default=5,
+                        help="Children of each ManyModel row.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds the stub server waits per request.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Timed runs of each scenario.")
+    parser.add_argument("--output", help="File the JSON report is written to.")
+    parser.add_argument("--compare", help="Previous JSON report to compare to.")
+    options = parser.parse_args()
+
+    report = run(options)
+    content = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(content)
+    else:
+        print(content)
+    if options.compare:
+        with open(options.compare) as baseline:
+            compare(report, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
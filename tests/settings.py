@@ -7,6 +7,7 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'django.contrib.auth',
     'rest_framework',
+    'drf_embedded_fields.apps.EmbeddedFieldsConfig',
     'test_app',
 )
 
@@ -16,6 +17,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+    },
 }
 
+DATABASE_ROUTERS = ['test_app.routers.EmbedReplicaRouter']
+
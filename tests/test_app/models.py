@@ -17,3 +17,14 @@ class ChildModel(models.Model):
 
 class ManyModel(models.Model):
     children = models.ManyToManyField(ChildModel)
+
+
+class TagModel(models.Model):
+    name = models.CharField(max_length=100)
+
+    class Meta:
+        ordering = ["name"]
+
+
+class TaggedModel(models.Model):
+    tags = models.ManyToManyField(TagModel)
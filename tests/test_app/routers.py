@@ -0,0 +1,9 @@
+class EmbedReplicaRouter:
+    """
+    Sends the embed queries routed with the "router" alias to the replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        if hints.get("embedded"):
+            return "replica"
+        return None
@@ -2,7 +2,8 @@ from rest_framework import serializers
 
 from drf_embedded_fields.api_fields import APIResourceIntField
 from drf_embedded_fields.model_fields import EmbeddableModelSerializer
-from test_app.models import ParentModel, ChildModel, ManyModel
+from test_app.models import ParentModel, ChildModel, ManyModel, \
+    TaggedModel
 
 
 class ExternalAPISerializer(serializers.Serializer):
@@ -34,7 +35,41 @@ class ChildSerializerWithSerializer(ChildSerializer):
     )
 
 
+class ChildBatchSerializer(ChildSerializer):
+    external_api_field = APIResourceIntField(
+        url="http://test-endpoint/api/v1/{id}/",
+        batch_url="http://test-endpoint/api/v1/?id__in={ids}",
+        batch_size=2,
+        included_headers=["Authorization"],
+    )
+
+
 class ManySerializer(EmbeddableModelSerializer):
     class Meta:
         model = ManyModel
         fields = "__all__"
+
+
+class TaggedSerializer(EmbeddableModelSerializer):
+    class Meta:
+        model = TaggedModel
+        fields = "__all__"
+
+
+class ParentWithChildrenSerializer(EmbeddableModelSerializer):
+    class Meta:
+        model = ParentModel
+        fields = "__all__"
+        embedded_reverse_relations = {
+            "childmodel_set": {"limit": 2, "ordering": ["-id"]},
+        }
+
+
+class WritableChildSerializer(ChildSerializer):
+    class Meta(ChildSerializer.Meta):
+        embedded_writable_fields = ["parent"]
+
+
+class WritableManySerializer(ManySerializer):
+    class Meta(ManySerializer.Meta):
+        embedded_writable_fields = ["children"]
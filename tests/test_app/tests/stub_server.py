@@ -0,0 +1,61 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """
+    Local HTTP server returning JSON responses by path, used to stand in for
+    the upstream APIs of the embedded fields.
+
+    :param dict responses: path -> (status code, json body)
+    :param float latency: Seconds to wait before answering each request.
+    """
+
+    def __init__(self, responses=None, latency=0):
+        self.responses = responses or {}
+        self.latency = latency
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.get_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                stub.requests.append(path)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, body = stub.responses.get(
+                    path, (404, {"message": "Not found."})
+                )
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
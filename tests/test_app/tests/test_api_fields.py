@@ -0,0 +1,358 @@
+from unittest.mock import patch, Mock
+
+import requests
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+from rest_framework import serializers
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from drf_embedded_fields.api_fields import APIResourceIntField
+from drf_embedded_fields.base import EmbeddableSerializerMixin
+from drf_embedded_fields.circuit_breaker import CircuitBreaker, \
+    get_circuit_breakers, reset_circuit_breakers
+from drf_embedded_fields.exceptions import CircuitOpenError, \
+    ResponseTooLargeError, ServiceValidationError
+from drf_embedded_fields.sessions import close_sessions
+from test_app.tests.stub_server import StubServer
+
+
+class TestAPIResourceFieldSessions(SimpleTestCase):
+    def tearDown(self) -> None:
+        close_sessions()
+
+    def test_session_is_reused_per_host(self):
+        field = APIResourceIntField(url="http://test-endpoint/api/v1/{id}/")
+        session = field.get_session("http://test-endpoint/api/v1/1/")
+        self.assertIs(
+            session, field.get_session("http://test-endpoint/api/v1/2/")
+        )
+        self.assertIsNot(
+            session, field.get_session("http://other-endpoint/api/v1/1/")
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"POOL_SIZE": 4, "RETRIES": 2})
+    def test_session_settings(self):
+        field = APIResourceIntField(
+            url="http://test-endpoint/api/v1/{id}/", backoff_factor=0.5
+        )
+        adapter = field.get_session("http://test-endpoint/").get_adapter(
+            "http://test-endpoint/"
+        )
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.5)
+        self.assertNotIn("POST", adapter.max_retries.allowed_methods)
+
+    @patch.object(requests.Session, "request")
+    def test_get_from_api_timeout(self, request):
+        request.return_value.status_code = 200
+        request.return_value.json.return_value = {"id": 1}
+        field = APIResourceIntField(url="http://test-endpoint/api/v1/{id}/")
+        field.get_from_api("http://test-endpoint/api/v1/1/", "get", {})
+        request.assert_called_once_with(
+            "get", "http://test-endpoint/api/v1/1/", headers={}, timeout=(5, 30)
+        )
+
+        field = APIResourceIntField(
+            url="http://test-endpoint/api/v1/{id}/", timeout=1
+        )
+        field.get_from_api("http://test-endpoint/api/v1/1/", "get", {})
+        self.assertEqual(request.call_args[1]["timeout"], 1)
+
+    def test_get_from_api_stub_server(self):
+        responses = {"/api/v1/1/": (200, {"id": 1})}
+        field = APIResourceIntField(url="/api/v1/{id}/")
+        with StubServer(responses) as stub:
+            data = field.get_from_api(stub.url + "/api/v1/1/", "get", {})
+        self.assertEqual(data, {"id": 1})
+
+
+class TestAPIResourceFieldDecoding(SimpleTestCase):
+    def tearDown(self) -> None:
+        close_sessions()
+
+    def get_serializer(self, query, **field_kwargs):
+        class ExternalSerializer(
+            EmbeddableSerializerMixin, serializers.Serializer
+        ):
+            external = APIResourceIntField(
+                url="http://test-endpoint/api/v1/{id}/", **field_kwargs
+            )
+
+        request = Request(APIRequestFactory().get("/" + query))
+        return ExternalSerializer(
+            {"external": 1}, context={"request": request}
+        )
+
+    @patch.object(APIResourceIntField, "get_from_api")
+    def test_trusted_rendering(self, get_from_api):
+        get_from_api.return_value = {"id": 1, "name": "External", "extra": 2}
+        serializer = self.get_serializer("?embed=external", trusted=True)
+        with patch.object(serializers.DictField, "to_representation") as dict_:
+            self.assertEqual(
+                serializer.data["external"],
+                {"id": 1, "name": "External", "extra": 2}
+            )
+        dict_.assert_not_called()
+
+        serializer = self.get_serializer(
+            "?embed=external&fields[external]=name,missing", trusted=True
+        )
+        self.assertEqual(serializer.data["external"], {"name": "External"})
+
+    def test_json_loads(self):
+        responses = {"/api/v1/1/": (200, {"id": 1})}
+        field = APIResourceIntField(
+            url="/api/v1/{id}/", json_loads="json.loads"
+        )
+        with StubServer(responses) as stub, \
+                patch("json.loads", return_value={"id": 2}) as json_loads:
+            data = field.get_from_api(stub.url + "/api/v1/1/", "get", {})
+        self.assertEqual(data, {"id": 2})
+        json_loads.assert_called_once_with(b'{"id": 1}')
+
+    @patch.object(requests.Session, "request")
+    def test_error_decoded_once(self, request):
+        request.return_value = Mock(status_code=400, headers={})
+        request.return_value.json.return_value = {"message": "Invalid"}
+        field = APIResourceIntField(url="http://test-endpoint/api/v1/{id}/")
+        with self.assertRaises(ServiceValidationError):
+            field.get_from_api("http://test-endpoint/api/v1/1/", "get", {})
+        request.return_value.json.assert_called_once_with()
+
+    def test_max_response_size(self):
+        responses = {
+            "/api/v1/1/": (200, {"id": 1}),
+            "/api/v1/2/": (200, {"id": 2, "content": "x" * 100}),
+        }
+        field = APIResourceIntField(
+            url="/api/v1/{id}/", max_response_size=64
+        )
+        with StubServer(responses) as stub:
+            data = field.get_from_api(stub.url + "/api/v1/1/", "get", {})
+            with self.assertRaises(ResponseTooLargeError):
+                field.get_from_api(stub.url + "/api/v1/2/", "get", {})
+        self.assertEqual(data, {"id": 1})
+
+    def test_max_response_size_without_length(self):
+        response = Mock(headers={})
+        response.iter_content.return_value = iter([b"x" * 40] * 10)
+        field = APIResourceIntField(
+            url="/api/v1/{id}/", max_response_size=64
+        )
+        with self.assertRaises(ResponseTooLargeError):
+            field.read_response(response)
+        response.close.assert_called_once_with()
+        self.assertEqual(next(response.iter_content.return_value), b"x" * 40)
+
+
+class TestAPIResourceFieldCache(SimpleTestCase):
+    url = "http://test-endpoint/api/v1/1/"
+
+    def setUp(self) -> None:
+        caches["default"].clear()
+        self.field = APIResourceIntField(
+            url="http://test-endpoint/api/v1/{id}/", cache_timeout=60
+        )
+
+    def get_response(self, status_code, data=None, etag=None):
+        response = Mock(status_code=status_code, headers={})
+        response.json.return_value = data
+        if etag:
+            response.headers["ETag"] = etag
+        return response
+
+    @patch.object(APIResourceIntField, "get_response")
+    def test_cached_response(self, get_response):
+        get_response.return_value = self.get_response(200, {"id": 1})
+        for _ in range(2):
+            data = self.field.get_from_api(
+                self.url, "get", {}, params={"embed": []}
+            )
+            self.assertEqual(data, {"id": 1})
+        get_response.assert_called_once_with(
+            self.url, "get", {}, params={"embed": []}
+        )
+
+    @patch.object(APIResourceIntField, "get_response")
+    def test_cache_key_uses_headers(self, get_response):
+        get_response.side_effect = [
+            self.get_response(200, {"id": 1, "user": "a"}),
+            self.get_response(200, {"id": 1, "user": "b"}),
+        ]
+        data_a = self.field.get_from_api(
+            self.url, "get", {"Authorization": "a"}
+        )
+        data_b = self.field.get_from_api(
+            self.url, "get", {"Authorization": "b"}
+        )
+        self.assertEqual(data_a["user"], "a")
+        self.assertEqual(data_b["user"], "b")
+
+    @patch("drf_embedded_fields.api_fields.time.time")
+    @patch.object(APIResourceIntField, "get_response")
+    def test_revalidation(self, get_response, now):
+        now.return_value = 1000
+        get_response.side_effect = [
+            self.get_response(200, {"id": 1}, etag='"v1"'),
+            self.get_response(304),
+        ]
+        self.field.get_from_api(self.url, "get", {})
+
+        now.return_value = 1061
+        data = self.field.get_from_api(self.url, "get", {})
+        self.assertEqual(data, {"id": 1})
+        get_response.assert_called_with(
+            self.url, "get", {"If-None-Match": '"v1"'}
+        )
+
+        # The revalidated entry is fresh again.
+        self.field.get_from_api(self.url, "get", {})
+        self.assertEqual(get_response.call_count, 2)
+
+    @patch.object(APIResourceIntField, "get_response")
+    def test_disabled_cache(self, get_response):
+        get_response.return_value = self.get_response(200, {"id": 1})
+        field = APIResourceIntField(url="http://test-endpoint/api/v1/{id}/")
+        field.get_from_api(self.url, "get", {})
+        field.get_from_api(self.url, "get", {})
+        self.assertEqual(get_response.call_count, 2)
+
+
+class TestCircuitBreaker(SimpleTestCase):
+    url = "http://test-endpoint/api/v1/1/"
+
+    def tearDown(self) -> None:
+        reset_circuit_breakers()
+
+    def get_serializer(self, **field_kwargs):
+        class ExternalSerializer(
+            EmbeddableSerializerMixin, serializers.Serializer
+        ):
+            external = APIResourceIntField(
+                url="http://test-endpoint/api/v1/{id}/",
+                circuit_failure_threshold=2, **field_kwargs
+            )
+
+        request = Request(APIRequestFactory().get("/?embed=external"))
+        return ExternalSerializer(
+            {"external": 1}, context={"request": request}
+        )
+
+    @patch("drf_embedded_fields.circuit_breaker.time.monotonic")
+    def test_breaker_states(self, now):
+        now.return_value = 0
+        breaker = CircuitBreaker("test", 2, window=10, cooldown=5)
+        breaker.record_failure()
+        now.return_value = 11
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        now.return_value = 16
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now.return_value = 21
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @patch("drf_embedded_fields.circuit_breaker.time.monotonic")
+    def test_half_open_single_trial(self, now):
+        now.return_value = 0
+        breaker = CircuitBreaker("test", 1, window=10, cooldown=5)
+        breaker.record_failure()
+        now.return_value = 6
+        self.assertEqual(
+            [breaker.allow_request() for _ in range(3)], [True, False, False]
+        )
+        breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+
+        now.return_value = 12
+        self.assertTrue(breaker.allow_request())
+        # A trial that records nothing is given up after a cooldown.
+        now.return_value = 17
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(
+            [breaker.allow_request() for _ in range(3)], [True] * 3
+        )
+
+    @patch.object(requests.Session, "request")
+    def test_fail_fast(self, request):
+        request.side_effect = requests.ConnectionError()
+        field = APIResourceIntField(
+            url="http://test-endpoint/api/v1/{id}/",
+            circuit_failure_threshold=2
+        )
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                field.get_from_api(self.url, "get", {})
+        with self.assertRaises(CircuitOpenError):
+            field.get_from_api(self.url, "get", {})
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(
+            get_circuit_breakers()["http://test-endpoint"]["state"], "open"
+        )
+
+    @patch.object(requests.Session, "request")
+    def test_server_errors_open_circuit(self, request):
+        request.return_value = Mock(status_code=503, headers={})
+        request.return_value.json.return_value = {"message": "Unavailable"}
+        field = APIResourceIntField(
+            url="http://test-endpoint/api/v1/{id}/",
+            circuit_failure_threshold=2
+        )
+        for _ in range(2):
+            with self.assertRaises(APIException):
+                field.get_from_api(self.url, "get", {})
+        with self.assertRaises(CircuitOpenError):
+            field.get_from_api(self.url, "get", {})
+
+    @patch.object(requests.Session, "request")
+    def test_fallbacks(self, request):
+        request.side_effect = requests.ConnectionError()
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                self.get_serializer().data
+
+        with self.assertRaises(CircuitOpenError):
+            self.get_serializer().data
+        self.assertEqual(
+            self.get_serializer(circuit_fallback="id").data, {"external": 1}
+        )
+        self.assertEqual(
+            self.get_serializer(
+                circuit_fallback="placeholder",
+                circuit_placeholder={"id": 1, "unavailable": True}
+            ).data,
+            {"external": {"id": 1, "unavailable": True}}
+        )
+        self.assertEqual(request.call_count, 2)
+
+    @patch("drf_embedded_fields.api_fields.time.time")
+    @patch.object(requests.Session, "request")
+    def test_stale_fallback(self, request, now):
+        caches["default"].clear()
+        response = Mock(status_code=200, headers={})
+        response.json.return_value = {"id": 1}
+        request.side_effect = [response] + [requests.ConnectionError()] * 2
+        field = APIResourceIntField(
+            url="http://test-endpoint/api/v1/{id}/", cache_timeout=60,
+            circuit_failure_threshold=2, circuit_fallback="stale"
+        )
+        now.return_value = 1000
+        field.get_from_api(self.url, "get", {})
+
+        now.return_value = 1061
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                field.get_from_api(self.url, "get", {})
+        self.assertEqual(field.get_from_api(self.url, "get", {}), {"id": 1})
+        self.assertEqual(request.call_count, 3)
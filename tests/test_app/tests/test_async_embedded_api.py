@@ -0,0 +1,108 @@
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APIRequestFactory
+
+from drf_embedded_fields.exceptions import ResponseTooLargeError
+from test_app.models import ParentModel, ChildModel, RootModel
+from test_app.serializers import ChildSerializer
+from test_app.tests.stub_server import StubServer
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+@skipUnless(httpx, "httpx is not installed")
+class TestAsyncEmbeddedAPI(APITestCase):
+    def setUp(self) -> None:
+        root = RootModel.objects.create(name="Test Root")
+        parent = ParentModel.objects.create(str_field="Parent 1", root=root)
+        for external_id in (1, 2, 1):
+            ChildModel.objects.create(
+                parent=parent, external_api_field=external_id
+            )
+        self.embedded_external_1 = {"id": 1, "field_1": "TestExternalAPI"}
+        self.embedded_external_2 = {"id": 2, "field_1": "TestExternalAPI2"}
+
+    def get_serializer(self, url, query="?embed=external_api_field", **kws):
+        request = Request(APIRequestFactory().get("/list/" + query))
+        serializer = ChildSerializer(
+            ChildModel.objects.all(), context={"request": request}, **kws
+        )
+        child = serializer.child if kws.get("many") else serializer
+        child.fields["external_api_field"].url = url + "/api/v1/{id}/"
+        return serializer
+
+    def test_adata_many(self):
+        responses = {
+            "/api/v1/1/": (200, self.embedded_external_1),
+            "/api/v1/2/": (200, self.embedded_external_2),
+        }
+        with StubServer(responses) as stub:
+            serializer = self.get_serializer(stub.url, many=True)
+            data = async_to_sync(serializer.adata)()
+
+        self.assertEqual(
+            [row["external_api_field"] for row in data],
+            [self.embedded_external_1, self.embedded_external_2,
+             self.embedded_external_1]
+        )
+        self.assertEqual(
+            sorted(stub.requests), ["/api/v1/1/", "/api/v1/2/"]
+        )
+
+    def test_adata_single(self):
+        responses = {"/api/v1/1/": (200, self.embedded_external_1)}
+        with StubServer(responses) as stub:
+            serializer = self.get_serializer(stub.url)
+            serializer.instance = ChildModel.objects.first()
+            data = async_to_sync(serializer.adata)()
+
+        self.assertEqual(data["external_api_field"], self.embedded_external_1)
+        self.assertEqual(stub.requests, ["/api/v1/1/"])
+
+    def test_adata_error(self):
+        responses = {
+            "/api/v1/1/": (200, self.embedded_external_1),
+            "/api/v1/2/": (404, {"message": "Not found.", "code": "missing"}),
+        }
+        with StubServer(responses) as stub:
+            serializer = self.get_serializer(stub.url, many=True)
+            with self.assertRaises(Exception) as ctx:
+                async_to_sync(serializer.adata)()
+
+        self.assertEqual(ctx.exception.status_code, 404)
+        self.assertEqual(ctx.exception.detail, "Not found.")
+
+    def test_adata_max_response_size(self):
+        responses = {
+            "/api/v1/1/": (200, self.embedded_external_1),
+            "/api/v1/2/": (200, dict(self.embedded_external_2, x="x" * 100)),
+        }
+        with StubServer(responses) as stub:
+            serializer = self.get_serializer(stub.url, many=True)
+            serializer.child.fields["external_api_field"].max_response_size = 64
+            with self.assertRaises(ResponseTooLargeError):
+                async_to_sync(serializer.adata)()
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"READ_TIMEOUT": 0.1})
+    def test_adata_timeout(self):
+        responses = {"/api/v1/1/": (200, self.embedded_external_1)}
+        with StubServer(responses, latency=0.5) as stub:
+            serializer = self.get_serializer(stub.url)
+            serializer.instance = ChildModel.objects.first()
+            with self.assertRaises(httpx.ReadTimeout):
+                async_to_sync(serializer.adata)()
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_REQUESTS": 1})
+    def test_adata_max_requests(self):
+        with StubServer() as stub:
+            serializer = self.get_serializer(stub.url, many=True)
+            with self.assertRaises(ValidationError):
+                async_to_sync(serializer.adata)()
+        self.assertEqual(stub.requests, [])
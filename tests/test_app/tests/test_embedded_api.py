@@ -1,9 +1,34 @@
-from unittest.mock import patch, call
+import json
+from unittest.mock import patch, call, Mock
 
-from rest_framework.test import APIClient, APITestCase
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.serializers import ModelSerializer
+from rest_framework.test import APIClient, APITestCase, APIRequestFactory
 
 from drf_embedded_fields.api_fields import APIEmbeddedMixin
-from test_app.models import ParentModel, ChildModel, RootModel, ManyModel
+from drf_embedded_fields.base import compile_embed_tree
+from drf_embedded_fields.instrumentation import embed_stats_collected
+from drf_embedded_fields import render_cache
+from drf_embedded_fields.render_cache import connect_invalidations, \
+    uses_render_invalidation, get_version_key
+from drf_embedded_fields.routing import use_primary, route_queryset
+from drf_embedded_fields.model_fields import \
+    get_default_embedded_serializer_class, clear_embeddable_fields_cache, \
+    get_values_converters
+from drf_embedded_fields.writes import build_embedded_instance, \
+    get_embedded_writes
+from test_app.models import ParentModel, ChildModel, RootModel, ManyModel, \
+    TagModel, TaggedModel
+from test_app.serializers import ChildSerializer, \
+    ParentWithChildrenSerializer
 
 
 class TestEmbeddedAPI(APITestCase):
@@ -119,8 +144,7 @@ class TestEmbeddedAPI(APITestCase):
     @patch.object(APIEmbeddedMixin, "get_from_api")
     def test_retrieve_from_list_embed_external(self, get_from_api):
         get_from_api.side_effect = [
-            self.embedded_external_1, self.embedded_external_1,
-            self.embedded_external_2
+            self.embedded_external_1, self.embedded_external_2
         ]
         res = self.c.get("/list/?embed=external_api_field")
         self.assertEqual(res.status_code, 200)
@@ -132,28 +156,26 @@ class TestEmbeddedAPI(APITestCase):
                  "external_api_field": self.embedded_external_1},
                 {"id": 2,
                  "parent": 1,
-                 "external_api_field": self.embedded_external_1},
+                 "external_api_field": self.embedded_external_2},
                 {"id": 3,
                  "parent": 2,
-                 "external_api_field": self.embedded_external_2},
+                 "external_api_field": self.embedded_external_1},
             ]
         )
+        self.assertEqual(get_from_api.call_count, 2)
         get_from_api.assert_has_calls(
             [
                 call("http://test-endpoint/api/v1/1/", "get", headers={},
                      params={"embed": []}),
                 call("http://test-endpoint/api/v1/2/", "get", headers={},
                      params={"embed": []}),
-                call("http://test-endpoint/api/v1/1/", "get", headers={},
-                     params={"embed": []}),
             ],
         )
 
     @patch.object(APIEmbeddedMixin, "get_from_api")
     def test_retrieve_from_list_embed_external_used_headers(self, get_from_api):
         get_from_api.side_effect = [
-            self.embedded_external_1, self.embedded_external_1,
-            self.embedded_external_2
+            self.embedded_external_1, self.embedded_external_2
         ]
         res = self.c.get(
             "/list/?embed=external_api_field",
@@ -169,17 +191,13 @@ class TestEmbeddedAPI(APITestCase):
                 call("http://test-endpoint/api/v1/2/", "get",
                      headers={"Authorization": "Bearer TokenHere"},
                      params={"embed": []}),
-                call("http://test-endpoint/api/v1/1/", "get",
-                     headers={"Authorization": "Bearer TokenHere"},
-                     params={"embed": []}),
             ],
         )
 
     @patch.object(APIEmbeddedMixin, "get_from_api")
     def test_retrieve_from_list_embed_external_nesting(self, get_from_api):
         get_from_api.side_effect = [
-            self.embedded_external_1, self.embedded_external_1,
-            self.embedded_external_2
+            self.embedded_external_1, self.embedded_external_2
         ]
         res = self.c.get("/list/?embed=external_api_field.other_field")
         self.assertEqual(res.status_code, 200)
@@ -191,10 +209,10 @@ class TestEmbeddedAPI(APITestCase):
                  "external_api_field": self.embedded_external_1},
                 {"id": 2,
                  "parent": 1,
-                 "external_api_field": self.embedded_external_1},
+                 "external_api_field": self.embedded_external_2},
                 {"id": 3,
                  "parent": 2,
-                 "external_api_field": self.embedded_external_2},
+                 "external_api_field": self.embedded_external_1},
             ]
         )
         get_from_api.assert_has_calls(
@@ -203,11 +221,106 @@ class TestEmbeddedAPI(APITestCase):
                      "get", headers={}, params={"embed": ["other_field"]}),
                 call("http://test-endpoint/api/v1/2/",
                      "get", headers={}, params={"embed": ["other_field"]}),
-                call("http://test-endpoint/api/v1/1/",
-                     "get", headers={}, params={"embed": ["other_field"]}),
             ],
         )
 
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_embed_external_calls_are_shared_by_request(self, get_from_api):
+        get_from_api.return_value = self.embedded_external_1
+        request = Request(
+            APIRequestFactory().get("/list/?embed=external_api_field")
+        )
+        for child in (self.child1, self.child3):
+            data = ChildSerializer(child, context={"request": request}).data
+            self.assertEqual(
+                data["external_api_field"], self.embedded_external_1
+            )
+        get_from_api.assert_called_once_with(
+            "http://test-endpoint/api/v1/1/", "get", headers={},
+            params={"embed": []}
+        )
+
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_retrieve_from_list_embed_external_batch(self, get_from_api):
+        get_from_api.return_value = [
+            self.embedded_external_1, self.embedded_external_2
+        ]
+        res = self.c.get(
+            "/list/batch/?embed=external_api_field",
+            **{"HTTP_AUTHORIZATION": "Bearer TokenHere"}
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [row["external_api_field"] for row in res.json()],
+            [self.embedded_external_1, self.embedded_external_2,
+             self.embedded_external_1]
+        )
+        get_from_api.assert_called_once_with(
+            "http://test-endpoint/api/v1/?id__in=1,2", "get",
+            headers={"Authorization": "Bearer TokenHere"},
+            params={"embed": []}
+        )
+
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_retrieve_from_list_embed_external_batch_chunks(
+            self, get_from_api
+    ):
+        ChildModel.objects.create(parent=self.parent2, external_api_field=3)
+        embedded_external_3 = {"id": 3, "field_1": "TestExternalAPI3"}
+        get_from_api.side_effect = [
+            {"results": [self.embedded_external_1, self.embedded_external_2]},
+            [],
+            embedded_external_3,
+        ]
+        res = self.c.get("/list/batch/?embed=external_api_field")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json()[-1]["external_api_field"], embedded_external_3
+        )
+        # The id missing from the batch response falls back to its own call.
+        get_from_api.assert_has_calls([
+            call("http://test-endpoint/api/v1/?id__in=1,2", "get",
+                 headers={}, params={"embed": []}),
+            call("http://test-endpoint/api/v1/?id__in=3", "get",
+                 headers={}, params={"embed": []}),
+            call("http://test-endpoint/api/v1/3/", "get",
+                 headers={}, params={"embed": []}),
+        ])
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"MAX_WORKERS": 4})
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_retrieve_from_list_embed_external_concurrent(self, get_from_api):
+        responses = {
+            "http://test-endpoint/api/v1/1/": self.embedded_external_1,
+            "http://test-endpoint/api/v1/2/": self.embedded_external_2,
+        }
+        get_from_api.side_effect = lambda url, *args, **kwargs: responses[url]
+        res = self.c.get("/list/?embed=external_api_field")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [row["external_api_field"] for row in res.json()],
+            [self.embedded_external_1, self.embedded_external_2,
+             self.embedded_external_1]
+        )
+        self.assertEqual(get_from_api.call_count, 2)
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"MAX_WORKERS": 4})
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_retrieve_from_list_embed_external_concurrent_error(
+            self, get_from_api
+    ):
+        def get_from_api_side_effect(url, *args, **kwargs):
+            if url.endswith("/2/"):
+                exc = APIException(detail="Unavailable")
+                exc.status_code = 502
+                raise exc
+            return self.embedded_external_1
+
+        get_from_api.side_effect = get_from_api_side_effect
+        res = self.c.get("/list/?embed=external_api_field")
+        self.assertEqual(res.status_code, 502)
+        self.assertEqual(res.json(), {"detail": "Unavailable"})
+
     def test_retrieve_from_many(self):
         res = self.c.get("/list/many/?embed=children")
         self.assertEqual(res.status_code, 200)
@@ -270,3 +383,849 @@ class TestEmbeddedAPI(APITestCase):
             res.json(),
             [{"id": 1, "children": [1, 2, 3]}]
         )
+
+    def test_embed_many_resolved_in_bulk(self):
+        other = ManyModel.objects.create()
+        other.children.add(self.child3)
+        ManyModel.objects.create()
+        # The many rows, the through rows, the distinct children and then
+        # the distinct parents and roots of all of them.
+        with self.assertNumQueries(5):
+            res = self.c.get("/list/many/?embed=children.parent.root")
+        self.assertEqual(res.status_code, 200)
+        data = res.json()
+        self.assertEqual(
+            [[child["id"] for child in row["children"]] for row in data],
+            [[1, 2, 3], [3], []]
+        )
+        self.assertEqual(
+            data[1]["children"][0]["parent"],
+            {"id": 2, "str_field": "Parent 2",
+             "root": {"id": 1, "name": "Test Root"}}
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"RENDER_CACHE_TIMEOUT": 60})
+    def test_embed_many_ordered_model(self):
+        caches["default"].clear()
+        connect_invalidations()
+        self.addCleanup(caches["default"].clear)
+        first = TaggedModel.objects.create()
+        second = TaggedModel.objects.create()
+        b, c, a = (TagModel.objects.create(name=name) for name in "bca")
+        first.tags.add(c)
+        # Caches the render of c, which is then loaded before the others.
+        self.c.get("/list/tagged/?embed=tags")
+        first.tags.add(a, b)
+        second.tags.add(b, a)
+        # The rows, the through rows in the tags ordering and the tags.
+        with self.assertNumQueries(3):
+            res = self.c.get("/list/tagged/?embed=tags")
+        self.assertEqual(
+            [[tag["name"] for tag in row["tags"]] for row in res.json()],
+            [["a", "b", "c"], ["a", "b"]]
+        )
+
+    def test_prefetched_embed_parent_root(self):
+        with self.assertNumQueries(1):
+            res = self.c.get("/list/prefetched/?embed=parent.root")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json(), self.c.get("/list/?embed=parent.root").json()
+        )
+
+    def test_prefetched_not_embedded(self):
+        with self.assertNumQueries(1):
+            res = self.c.get("/list/prefetched/")
+        self.assertEqual(res.json(), self.c.get("/list/").json())
+
+    def test_prefetched_many_nested(self):
+        with self.assertNumQueries(3):
+            res = self.c.get("/list/many/prefetched/?embed=children.parent")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json(),
+            self.c.get("/list/many/?embed=children.parent").json()
+        )
+
+    def test_embed_parent_resolved_in_bulk(self):
+        # One query for the children and one for all distinct parents.
+        with self.assertNumQueries(2):
+            res = self.c.get("/list/?embed=parent")
+        self.assertEqual(
+            [row["parent"]["id"] for row in res.json()], [1, 1, 2]
+        )
+
+    def test_default_embedded_serializer_class_is_cached(self):
+        field = ChildSerializer(
+            context={"embed_fields": ["parent"]}
+        ).fields["parent"]
+        serializer_class = field.get_embed_serializer_class()
+        self.assertIs(serializer_class, field.get_embed_serializer_class())
+        self.assertIs(
+            serializer_class,
+            get_default_embedded_serializer_class(ParentModel)
+        )
+        self.assertEqual(serializer_class.Meta.model, ParentModel)
+
+    def test_embed_parent_root_resolved_in_bulk(self):
+        # Children, distinct parents and distinct roots.
+        with self.assertNumQueries(3):
+            res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(
+            [row["parent"]["root"]["name"] for row in res.json()],
+            ["Test Root"] * 3
+        )
+
+    def test_embedded_serializer_is_reused(self):
+        context = {"embed_fields": ["parent.root"]}
+        serializer = ChildSerializer(
+            ChildModel.objects.all(), many=True, context=context
+        )
+        data = serializer.data
+        field = serializer.child.fields["parent"]
+        self.assertEqual(len(data), 3)
+        self.assertEqual(len(field.embed_serializers), 1)
+        self.assertIs(
+            field.get_serializer(None, ["root"]),
+            list(field.embed_serializers.values())[0]
+        )
+        self.assertEqual(context, {"embed_fields": ["parent.root"]})
+
+    def test_values_converters_custom_fields(self):
+        serializer_class = get_default_embedded_serializer_class(ParentModel)
+        context = {"request": Request(APIRequestFactory().get("/list/"))}
+        self.assertIsNotNone(get_values_converters(
+            serializer_class(context=context), ParentModel
+        ))
+
+        class UpperField(serializers.CharField):
+            def get_attribute(self, instance):
+                return instance.str_field.upper()
+
+        for field in (
+            serializers.ModelField(ParentModel._meta.get_field("str_field")),
+            UpperField(),
+        ):
+            serializer = serializer_class(context=context)
+            serializer.fields["str_field"] = field
+            self.assertIsNone(get_values_converters(serializer, ParentModel))
+
+    def test_embed_sparse_fieldsets(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.get(
+                "/list/?embed=parent.root&fields[parent]=str_field,root"
+                "&fields[parent.root]=name"
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json()[0],
+            {"id": 1,
+             "parent": {"str_field": "Parent 1", "root": {"name": "Test Root"}},
+             "external_api_field": 1}
+        )
+        self.assertEqual(len(queries), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.c.get("/list/?embed=parent&fields[parent]=str_field")
+        self.assertNotIn(
+            '"test_app_parentmodel"."root_id"', queries[1]["sql"]
+        )
+
+    def test_prefetched_embed_sparse_fieldsets(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.get(
+                "/list/prefetched/?embed=parent&fields[parent]=str_field"
+            )
+        self.assertEqual(
+            [row["parent"] for row in res.json()],
+            [{"str_field": "Parent 1"}, {"str_field": "Parent 1"},
+             {"str_field": "Parent 2"}]
+        )
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn(
+            '"test_app_parentmodel"."root_id"', queries[0]["sql"]
+        )
+
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_embed_external_sparse_fieldsets(self, get_from_api):
+        get_from_api.side_effect = [
+            self.embedded_external_1, self.embedded_external_2
+        ]
+        res = self.c.get(
+            "/list/?embed=external_api_field"
+            "&fields[external_api_field]=id,field_1"
+        )
+        self.assertEqual(res.status_code, 200)
+        get_from_api.assert_has_calls([
+            call("http://test-endpoint/api/v1/1/", "get", headers={},
+                 params={"embed": [], "fields": "id,field_1"}),
+            call("http://test-endpoint/api/v1/2/", "get", headers={},
+                 params={"embed": [], "fields": "id,field_1"}),
+        ])
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_DEPTH": 1})
+    def test_embed_max_depth(self):
+        res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(),
+            {"embed": ["The embed depth of 2 exceeds the maximum of 1."]}
+        )
+        self.assertEqual(self.c.get("/list/?embed=parent").status_code, 200)
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_PATHS": 2})
+    def test_embed_max_paths(self):
+        res = self.c.get(
+            "/list/?embed=parent.root&embed=external_api_field"
+        )
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(),
+            {"embed": ["The 3 embedded paths exceed the maximum of 2."]}
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_QUERIES": 1})
+    def test_embed_max_queries(self):
+        self.assertEqual(self.c.get("/list/?embed=parent").status_code, 200)
+        with self.assertNumQueries(1):
+            res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(),
+            {"embed": ["The embedded fields would need about 2 database "
+                       "queries, exceeding the maximum of 1."]}
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_REQUESTS": 1})
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_embed_max_requests(self, get_from_api):
+        res = self.c.get("/list/?embed=external_api_field")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(),
+            {"embed": ["The embedded fields would need about 2 API "
+                       "requests, exceeding the maximum of 1."]}
+        )
+        get_from_api.assert_not_called()
+
+        get_from_api.return_value = [
+            self.embedded_external_1, self.embedded_external_2
+        ]
+        res = self.c.get("/list/batch/?embed=external_api_field")
+        self.assertEqual(res.status_code, 200)
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_REQUESTS": 2})
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_embed_max_requests_counts_distinct_resources(self, get_from_api):
+        ChildModel.objects.bulk_create(
+            ChildModel(parent=self.parent1, external_api_field=1)
+            for _ in range(20)
+        )
+        get_from_api.side_effect = [
+            self.embedded_external_1, self.embedded_external_2
+        ]
+        res = self.c.get("/list/?embed=external_api_field")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(get_from_api.call_count, 2)
+
+    def test_embed_unknown_fields(self):
+        res = self.c.get(
+            "/list/?embed=parent.unknown&embed=other&embed=parent.root"
+        )
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(),
+            {"embed": ["Unknown embed field(s): parent.unknown, other."]}
+        )
+
+    def test_embed_fields_left_out_by_fieldsets(self):
+        res = self.c.get("/list/?embed=parent.root&fields[parent]=str_field")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()[0]["parent"], {"str_field": "Parent 1"})
+
+        res = self.c.get(
+            "/list/?embed=parent.unknown&fields[parent]=str_field"
+        )
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(), {"embed": ["Unknown embed field(s): parent.unknown."]}
+        )
+
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_embed_unknown_fields_external_not_checked(self, get_from_api):
+        get_from_api.side_effect = [
+            self.embedded_external_1, self.embedded_external_2
+        ]
+        res = self.c.get("/list/?embed=external_api_field.other_field")
+        self.assertEqual(res.status_code, 200)
+
+    def test_embed_tree_is_compiled_once(self):
+        tree = compile_embed_tree(["parent.root", "external_api_field"])
+        self.assertIs(
+            compile_embed_tree(["parent.root", "external_api_field"]), tree
+        )
+        self.assertEqual(
+            list(tree.paths()), ["parent.root", "external_api_field"]
+        )
+        self.assertEqual((tree.depth, tree.size), (2, 3))
+
+        serializer = ChildSerializer(
+            ChildModel.objects.all(), many=True,
+            context={"embed_fields": ["parent.root"]}
+        )
+        serializer.data
+        parent = serializer.child.fields["parent"]
+        self.assertIs(
+            parent.embed_relations, serializer.child.embed_fields["parent"]
+        )
+        self.assertIs(
+            parent.get_embedded_serializer().embed_fields,
+            parent.embed_relations
+        )
+
+    def test_embeddable_fields_are_cached_per_class(self):
+        serializer_class = get_default_embedded_serializer_class(ManyModel)
+        clear_embeddable_fields_cache()
+        with patch.object(
+            ModelSerializer, "get_fields", autospec=True,
+            side_effect=ModelSerializer.get_fields
+        ) as get_fields:
+            first = serializer_class(context={"embed_fields": ["children"]})
+            second = serializer_class(context={"embed_fields": []})
+        self.assertEqual(get_fields.call_count, 1)
+
+        children = first.fields["children"]
+        self.assertIsNot(children, second.fields["children"])
+        self.assertIs(children.child_relation.parent, children)
+        self.assertTrue(children.embed)
+        self.assertFalse(second.fields["children"].embed)
+        self.assertEqual(
+            first.to_representation(self.many)["children"][0]["id"],
+            self.child1.pk
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={
+        "INSTRUMENTATION": True, "SERVER_TIMING": True
+    })
+    @patch.object(APIEmbeddedMixin, "get_session")
+    def test_embed_instrumentation(self, get_session):
+        get_session.return_value.request.return_value = Mock(
+            status_code=200, json=Mock(return_value=self.embedded_external_1)
+        )
+        collected = []
+
+        def receiver(request, stats, **kwargs):
+            collected.append(stats.as_dict())
+
+        embed_stats_collected.connect(receiver)
+        self.addCleanup(embed_stats_collected.disconnect, receiver)
+        res = self.c.get(
+            "/list/instrumented/?embed=parent.root&embed=external_api_field"
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(collected), 1)
+        stats = collected[0]
+        self.assertEqual(
+            set(stats), {"parent", "parent.root", "external_api_field"}
+        )
+        self.assertEqual(stats["parent"]["count"], 4)
+        self.assertEqual(stats["parent"]["queries"], 2)
+        self.assertEqual(stats["parent.root"]["queries"], 1)
+        self.assertEqual(stats["external_api_field"]["calls"], 2)
+        self.assertEqual(stats["parent"]["calls"], 0)
+        self.assertIn(
+            'embed.parent.root;dur=', res.headers["Server-Timing"]
+        )
+        self.assertIn(
+            'desc="0 queries, 2 calls"', res.headers["Server-Timing"]
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={
+        "INSTRUMENTATION": True, "SERVER_TIMING": True
+    })
+    def test_embed_instrumentation_streamed(self):
+        collected = []
+
+        def receiver(request, stats, **kwargs):
+            collected.append(stats.as_dict())
+
+        embed_stats_collected.connect(receiver)
+        self.addCleanup(embed_stats_collected.disconnect, receiver)
+        res = self.c.get("/list/stream/instrumented/?embed=parent.root")
+        self.assertEqual(collected, [])
+        self.assertEqual(len(json.loads(b"".join(res.streaming_content))), 3)
+        self.assertEqual(len(collected), 1)
+        # The prefetch of each chunk of 2 and the rendering of each child,
+        # loading the parents and roots of each chunk.
+        self.assertEqual(collected[0]["parent"]["count"], 5)
+        self.assertEqual(collected[0]["parent"]["queries"], 4)
+        self.assertNotIn("Server-Timing", res.headers)
+
+    def test_embed_instrumentation_disabled(self):
+        res = self.c.get("/list/instrumented/?embed=parent")
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("Server-Timing", res.headers)
+
+    def test_streamed_list(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.get("/list/stream/?embed=parent.root")
+            content = b"".join(res.streaming_content)
+        # The children, then the parents and roots of each chunk of 2.
+        self.assertEqual(len(queries), 5)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res["Content-Type"], "application/json")
+        self.assertEqual(
+            json.loads(content), self.c.get("/list/?embed=parent.root").json()
+        )
+
+    def test_streamed_list_many_prefetched(self):
+        res = self.c.get("/list/many/stream/?embed=children.parent")
+        self.assertEqual(
+            json.loads(b"".join(res.streaming_content)),
+            self.c.get("/list/many/?embed=children.parent").json()
+        )
+
+    def test_streamed_list_clears_embedded_content(self):
+        request = Request(APIRequestFactory().get("/", {"embed": "parent"}))
+        serializer = ChildSerializer(
+            ChildModel.objects.all(), many=True, context={"request": request}
+        )
+        parent = serializer.child.fields["parent"]
+        loaded = []
+        for item in serializer.iter_representation(serializer.instance, 2):
+            loaded.append(len(parent.embedded_values))
+        self.assertEqual(loaded, [1, 1, 1])
+        self.assertEqual(parent.embedded_values, {})
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_MAX_REQUESTS": 1})
+    @patch.object(APIEmbeddedMixin, "get_from_api")
+    def test_streamed_list_max_requests(self, get_from_api):
+        get_from_api.return_value = self.embedded_external_1
+        # The first chunk embeds the resources 1 and 2.
+        res = self.c.get("/list/stream/?embed=external_api_field")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            res.json(),
+            {"embed": ["The embedded fields would need about 2 API "
+                       "requests, exceeding the maximum of 1."]}
+        )
+        get_from_api.assert_not_called()
+
+        ChildModel.objects.update(external_api_field=1)
+        res = self.c.get("/list/stream/?embed=external_api_field")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(b"".join(res.streaming_content))), 3)
+        self.assertEqual(get_from_api.call_count, 2)
+
+    def test_streamed_empty_list(self):
+        ChildModel.objects.all().delete()
+        res = self.c.get("/list/stream/")
+        self.assertEqual(b"".join(res.streaming_content), b"[]")
+
+    def test_reverse_relation_not_embedded(self):
+        with self.assertNumQueries(1):
+            res = self.c.get("/list/parents/")
+        self.assertEqual(
+            res.json()[0], {"id": 1, "str_field": "Parent 1", "root": 1}
+        )
+
+    def test_reverse_relation_embedded_with_limit(self):
+        ChildModel.objects.create(parent=self.parent1, external_api_field=3)
+        # The parents, then their limited children and the children parents.
+        with self.assertNumQueries(3):
+            res = self.c.get("/list/parents/?embed=childmodel_set.parent")
+        self.assertEqual(res.status_code, 200)
+        data = res.json()
+        self.assertEqual(
+            [[child["id"] for child in row["childmodel_set"]] for row in data],
+            [[4, 2], [3]]
+        )
+        self.assertEqual(
+            data[1]["childmodel_set"][0],
+            {"id": 3, "external_api_field": 1,
+             "parent": {"id": 2, "str_field": "Parent 2", "root": 1}}
+        )
+
+    @patch("drf_embedded_fields.model_fields.WINDOW_FILTERS", False)
+    def test_reverse_relation_limit_without_window_filters(self):
+        ChildModel.objects.create(parent=self.parent1, external_api_field=3)
+        res = self.c.get("/list/parents/?embed=childmodel_set")
+        self.assertEqual(
+            [[child["id"] for child in row["childmodel_set"]]
+             for row in res.json()],
+            [[4, 2], [3]]
+        )
+
+    def test_reverse_relation_single_instance(self):
+        request = Request(
+            APIRequestFactory().get("/", {"embed": "childmodel_set"})
+        )
+        serializer = ParentWithChildrenSerializer(
+            self.parent1, context={"request": request}
+        )
+        self.assertEqual(
+            [child["id"] for child in serializer.data["childmodel_set"]],
+            [2, 1]
+        )
+
+    def test_embed_default_serializer_from_values(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.get("/list/?embed=parent")
+        self.assertEqual(
+            res.json()[2]["parent"],
+            {"id": 2, "str_field": "Parent 2", "root": 1}
+        )
+        serializer = ChildSerializer(
+            ChildModel.objects.all(), many=True,
+            context={"embed_fields": ["parent"]}
+        )
+        with patch.object(
+            ParentModel, "from_db", side_effect=AssertionError
+        ):
+            self.assertEqual(serializer.data, res.json())
+        self.assertEqual(len(queries), 2)
+
+    def test_embed_nested_not_from_values(self):
+        serializer = ChildSerializer(
+            ChildModel.objects.all(), many=True,
+            context={"embed_fields": ["parent.root"]}
+        )
+        serializer.data
+        parent = serializer.child.fields["parent"]
+        self.assertEqual(parent.embedded_values, {})
+        self.assertEqual(set(parent.embedded_instances), {1, 2})
+        root = parent.get_embedded_serializer().fields["root"]
+        self.assertEqual(list(root.embedded_values), [1])
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"RENDER_CACHE_TIMEOUT": 60})
+    def test_embed_render_cache(self):
+        caches["default"].clear()
+        connect_invalidations()
+        self.addCleanup(caches["default"].clear)
+        expected = self.c.get("/list/?embed=parent.root").json()
+        with self.assertNumQueries(1):
+            res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(res.json(), expected)
+
+        self.parent2.str_field = "Parent 2 Updated"
+        self.parent2.save()
+        with self.assertNumQueries(2):
+            res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(
+            [row["parent"]["str_field"] for row in res.json()],
+            ["Parent 1", "Parent 1", "Parent 2 Updated"]
+        )
+
+        self.root.name = "Root Updated"
+        self.root.save()
+        res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(
+            res.json()[0]["parent"]["root"],
+            {"id": 1, "name": "Root Updated"}
+        )
+        # Variants without the root are not invalidated by its changes.
+        self.c.get("/list/?embed=parent")
+        self.root.save()
+        with self.assertNumQueries(1):
+            self.c.get("/list/?embed=parent")
+
+    def test_render_invalidation_setting(self):
+        self.assertFalse(uses_render_invalidation())
+        with override_settings(
+                DRF_EMBEDDED_FIELDS={"RENDER_CACHE_TIMEOUT": 60}
+        ):
+            self.assertTrue(uses_render_invalidation())
+        with override_settings(DRF_EMBEDDED_FIELDS={
+            "RENDER_CACHE_TIMEOUT": 60, "RENDER_CACHE_INVALIDATION": False
+        }):
+            self.assertFalse(uses_render_invalidation())
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"RENDER_CACHE_TIMEOUT": 60})
+    def test_render_cache_requires_invalidation(self):
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+        with patch.object(render_cache, "_connected_models", {
+            "test_app.parentmodel"
+        }):
+            with self.assertRaisesMessage(
+                ImproperlyConfigured, "invalidation of test_app.rootmodel"
+            ):
+                self.c.get("/list/?embed=parent.root")
+        connect_invalidations()
+        res = self.c.get("/list/?embed=parent.root")
+        self.assertEqual(res.status_code, 200)
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"RENDER_CACHE_TIMEOUT": 60})
+    def test_render_cache_invalidated_without_renders(self):
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+        connect_invalidations()
+        # The entries cached by other processes are invalidated by saves in
+        # a process that never rendered the model.
+        self.parent1.save()
+        self.assertEqual(caches["default"].get(
+            get_version_key(ParentModel, self.parent1.pk)
+        ), 1)
+        self.parent1.save()
+        self.assertEqual(caches["default"].get(
+            get_version_key(ParentModel, self.parent1.pk)
+        ), 2)
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"RENDER_CACHE_TIMEOUT": 60})
+    def test_embed_many_render_cache(self):
+        caches["default"].clear()
+        connect_invalidations()
+        self.addCleanup(caches["default"].clear)
+        self.c.get("/list/many/?embed=children")
+        # The many rows and the through rows, the children are cached.
+        with self.assertNumQueries(2):
+            self.c.get("/list/many/?embed=children")
+
+        self.child2.external_api_field = 5
+        self.child2.save()
+        self.many.children.remove(self.child3)
+        res = self.c.get("/list/many/?embed=children")
+        children = res.json()[0]["children"]
+        self.assertEqual(
+            [child["external_api_field"] for child in children], [1, 5]
+        )
+
+    def count_writes(self, queries):
+        return {
+            statement: sum(
+                query["sql"].startswith(statement) for query in queries
+            )
+            for statement in ("INSERT", "UPDATE")
+        }
+
+    def test_bulk_create_embedded_objects(self):
+        data = [
+            {"parent": {"str_field": "New 1", "root": self.root.pk},
+             "external_api_field": 1},
+            {"parent": {"str_field": "New 2", "root": self.root.pk},
+             "external_api_field": 2},
+            {"parent": self.parent1.pk, "external_api_field": 3},
+            {"parent": {"id": self.parent2.pk, "str_field": "Renamed"},
+             "external_api_field": 4},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.post("/list/bulk/?embed=parent", data, format="json")
+        self.assertEqual(res.status_code, 201, res.content)
+        # One bulk insert of the parents, one of the children and one bulk
+        # update of the parents.
+        self.assertEqual(
+            self.count_writes(queries), {"INSERT": 2, "UPDATE": 1}
+        )
+        # The parents and the roots are validated with one query each, plus
+        # the savepoint of the transaction.
+        self.assertEqual(len(queries), 7)
+        self.assertEqual(
+            [row["parent"]["str_field"] for row in res.json()],
+            ["New 1", "New 2", "Parent 1", "Renamed"]
+        )
+        self.assertEqual(
+            list(ChildModel.objects.filter(external_api_field__gt=0).order_by(
+                "-id"
+            ).values_list("parent__str_field", flat=True)[:4]),
+            ["Renamed", "Parent 1", "New 2", "New 1"]
+        )
+
+    def test_bulk_create_embedded_many(self):
+        data = [
+            {"children": [
+                {"parent": self.parent1.pk, "external_api_field": 5},
+                self.child1.pk,
+            ]},
+            {"children": [
+                {"parent": self.parent2.pk, "external_api_field": 6},
+            ]},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.post("/list/many/bulk/", data, format="json")
+        self.assertEqual(res.status_code, 201, res.content)
+        # The many rows, the children and the through rows.
+        self.assertEqual(
+            self.count_writes(queries), {"INSERT": 3, "UPDATE": 0}
+        )
+        first, second = ManyModel.objects.filter(
+            pk__in=[row["id"] for row in res.json()]
+        ).order_by("pk")
+        self.assertEqual(
+            sorted(first.children.values_list("external_api_field", flat=True)),
+            [1, 5]
+        )
+        self.assertEqual(
+            list(second.children.values_list("external_api_field", flat=True)),
+            [6]
+        )
+
+    def test_list_create_without_opt_in(self):
+        saved = []
+
+        def receiver(sender, instance, created, **kwargs):
+            saved.append(instance.pk)
+
+        post_save.connect(receiver, sender=ChildModel)
+        self.addCleanup(post_save.disconnect, receiver, sender=ChildModel)
+        request = Request(APIRequestFactory().post("/list/"))
+        serializer = ChildSerializer(data=[
+            {"parent": self.parent1.pk, "external_api_field": 1},
+            {"parent": self.parent2.pk, "external_api_field": 2},
+        ], many=True, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+        instances = serializer.save()
+        self.assertEqual(saved, [instance.pk for instance in instances])
+
+    def test_create_embedded_object(self):
+        res = self.c.post("/list/bulk/", {
+            "parent": {"str_field": "New", "root": self.root.pk},
+            "external_api_field": 1
+        }, format="json")
+        self.assertEqual(res.status_code, 201, res.content)
+        child = ChildModel.objects.get(pk=res.json()["id"])
+        self.assertEqual(child.parent.str_field, "New")
+
+        res = self.c.post("/list/", {
+            "parent": {"str_field": "New", "root": self.root.pk},
+            "external_api_field": 1
+        }, format="json")
+        self.assertEqual(res.status_code, 400)
+
+    def test_bulk_create_embedded_errors(self):
+        count = ParentModel.objects.count()
+        res = self.c.post("/list/bulk/", [
+            {"parent": {"str_field": "New"}, "external_api_field": 1},
+            {"parent": {"id": 100, "str_field": "New"},
+             "external_api_field": 1},
+        ], format="json")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json()["0"]["parent"], {
+            "root": ["This field is required."]
+        })
+        self.assertEqual(
+            res.json()["1"]["parent"],
+            ['Invalid pk "100" - object does not exist.']
+        )
+        self.assertEqual(ParentModel.objects.count(), count)
+
+    def test_bulk_create_same_embedded_object(self):
+        res = self.c.post("/list/bulk/?embed=parent", [
+            {"parent": {"id": self.parent2.pk, "str_field": "X"},
+             "external_api_field": 1},
+            {"parent": {"id": self.parent2.pk, "str_field": "Y"},
+             "external_api_field": 2},
+        ], format="json")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json()["1"]["parent"], {
+            "str_field": ["Conflicts with another update of the same object."]
+        })
+        self.parent2.refresh_from_db()
+        self.assertEqual(self.parent2.str_field, "Parent 2")
+
+        root = RootModel.objects.create(name="Other")
+        with CaptureQueriesContext(connection) as queries:
+            res = self.c.post("/list/bulk/?embed=parent", [
+                {"parent": {"id": self.parent2.pk, "str_field": "X"},
+                 "external_api_field": 1},
+                {"parent": {"id": self.parent2.pk, "str_field": "X",
+                            "root": root.pk},
+                 "external_api_field": 2},
+            ], format="json")
+        self.assertEqual(res.status_code, 201, res.content)
+        self.assertEqual(
+            self.count_writes(queries), {"INSERT": 1, "UPDATE": 1}
+        )
+        self.assertEqual(
+            [row["parent"]["root"] for row in res.json()], [root.pk, root.pk]
+        )
+        self.parent2.refresh_from_db()
+        self.assertEqual(
+            (self.parent2.str_field, self.parent2.root), ("X", root)
+        )
+
+    def test_embedded_writes_same_row(self):
+        first = ParentModel.objects.get(pk=self.parent1.pk)
+        second = ParentModel.objects.get(pk=self.parent1.pk)
+        build_embedded_instance(ParentModel, {"str_field": "X"}, first)
+        build_embedded_instance(ParentModel, {"root": self.root}, second)
+        levels = get_embedded_writes([first, second])
+        self.assertEqual(levels, [[first]])
+        self.assertEqual(first._embedded_write.update_fields, [
+            "root", "str_field"
+        ])
+        self.assertEqual(second.str_field, "X")
+
+        build_embedded_instance(ParentModel, {"str_field": "Y"}, second)
+        with self.assertRaises(ValidationError):
+            get_embedded_writes([first, second])
+
+
+class TestEmbedDatabaseRouting(APITestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self) -> None:
+        self.c = APIClient()
+        for using, name in (("default", "Parent"), ("replica", "Replica")):
+            root = RootModel.objects.using(using).create(name="Root")
+            ParentModel.objects.using(using).create(
+                str_field=name, root=root
+            )
+        ChildModel.objects.create(parent_id=1, external_api_field=1)
+
+    def get_parent_field(self, method):
+        request = Request(getattr(APIRequestFactory(), method)("/"))
+        serializer = ChildSerializer(context={"request": request})
+        return serializer.fields["parent"]
+
+    def test_embed_default_database(self):
+        res = self.c.get("/list/?embed=parent")
+        self.assertEqual(res.json()[0]["parent"]["str_field"], "Parent")
+        queryset = ParentModel.objects.using("replica")
+        request = APIRequestFactory().post("/")
+        self.assertEqual(route_queryset(queryset, request).db, "replica")
+        self.assertEqual(
+            self.get_parent_field("post").get_queryset().db, "default"
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_DATABASE": "replica"})
+    def test_embed_database(self):
+        res = self.c.get("/list/?embed=parent")
+        self.assertEqual(res.json()[0]["parent"]["str_field"], "Replica")
+        self.assertEqual(
+            self.get_parent_field("get").get_queryset().db, "replica"
+        )
+
+    @override_settings(DRF_EMBEDDED_FIELDS={
+        "EMBED_DATABASE": "replica", "INSTRUMENTATION": True
+    })
+    def test_embed_database_instrumentation(self):
+        collected = []
+
+        def receiver(request, stats, **kwargs):
+            collected.append(stats.as_dict())
+
+        embed_stats_collected.connect(receiver)
+        self.addCleanup(embed_stats_collected.disconnect, receiver)
+        self.c.get("/list/instrumented/?embed=parent")
+        self.assertEqual(collected[0]["parent"]["queries"], 1)
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_DATABASE": "router"})
+    def test_embed_database_router(self):
+        res = self.c.get("/list/?embed=parent")
+        self.assertEqual(res.json()[0]["parent"]["str_field"], "Replica")
+
+    @override_settings(DRF_EMBEDDED_FIELDS={"EMBED_DATABASE": "replica"})
+    def test_embed_database_sticky_primary(self):
+        self.assertEqual(
+            self.get_parent_field("post").get_queryset().db, "default"
+        )
+        field = self.get_parent_field("get")
+        use_primary(field.context["request"])
+        self.assertEqual(field.get_queryset().db, "default")
+
+        with override_settings(DRF_EMBEDDED_FIELDS={
+            "EMBED_DATABASE": "replica", "EMBED_STICKY_PRIMARY": False
+        }):
+            self.assertEqual(
+                self.get_parent_field("post").get_queryset().db, "replica"
+            )
@@ -5,6 +5,20 @@ from . import views
 urlpatterns = [
     path("list/", views.ListChildView.as_view()),
     path("list/with-serializer/", views.ListChildWithSerializer.as_view()),
-    path("list/many/", views.ListManyView.as_view())
+    path("list/batch/", views.ListChildBatchView.as_view()),
+    path("list/many/", views.ListManyView.as_view()),
+    path("list/tagged/", views.ListTaggedView.as_view()),
+    path("list/prefetched/", views.ListChildPrefetchedView.as_view()),
+    path("list/many/prefetched/", views.ListManyPrefetchedView.as_view()),
+    path("list/instrumented/", views.ListChildInstrumentedView.as_view()),
+    path("list/parents/", views.ListParentView.as_view()),
+    path("list/stream/", views.ListChildStreamingView.as_view()),
+    path(
+        "list/stream/instrumented/",
+        views.ListChildStreamingInstrumentedView.as_view()
+    ),
+    path("list/many/stream/", views.ListManyStreamingView.as_view()),
+    path("list/bulk/", views.ListChildBulkView.as_view()),
+    path("list/many/bulk/", views.ListManyBulkView.as_view()),
 ]
 
@@ -1,7 +1,13 @@
 from rest_framework.generics import ListCreateAPIView
 
-from test_app.models import ChildModel, ManyModel
-from test_app.serializers import ChildSerializer, ManySerializer
+from drf_embedded_fields.views import EmbeddedQuerySetMixin, \
+    EmbeddedInstrumentationMixin, EmbeddedStreamingMixin, \
+    EmbeddedBulkCreateMixin
+from test_app.models import ChildModel, ManyModel, ParentModel, \
+    TaggedModel
+from test_app.serializers import ChildSerializer, ManySerializer, \
+    ChildBatchSerializer, ParentWithChildrenSerializer, TaggedSerializer, \
+    WritableChildSerializer, WritableManySerializer
 
 
 class ListChildView(ListCreateAPIView):
@@ -14,6 +20,68 @@ class ListChildWithSerializer(ListCreateAPIView):
     queryset = ChildModel.objects.all()
 
 
+class ListChildBatchView(ListCreateAPIView):
+    serializer_class = ChildBatchSerializer
+    queryset = ChildModel.objects.all()
+
+
 class ListManyView(ListCreateAPIView):
     serializer_class = ManySerializer
     queryset = ManyModel.objects.all()
+
+
+class ListTaggedView(ListCreateAPIView):
+    serializer_class = TaggedSerializer
+    queryset = TaggedModel.objects.all()
+
+
+class ListChildPrefetchedView(EmbeddedQuerySetMixin, ListCreateAPIView):
+    serializer_class = ChildSerializer
+    queryset = ChildModel.objects.all()
+
+
+class ListManyPrefetchedView(EmbeddedQuerySetMixin, ListCreateAPIView):
+    serializer_class = ManySerializer
+    queryset = ManyModel.objects.all()
+
+
+class ListChildInstrumentedView(EmbeddedInstrumentationMixin,
+                                ListCreateAPIView):
+    serializer_class = ChildSerializer
+    queryset = ChildModel.objects.all()
+
+
+class ListChildStreamingView(EmbeddedStreamingMixin, ListCreateAPIView):
+    serializer_class = ChildSerializer
+    queryset = ChildModel.objects.all()
+    stream_chunk_size = 2
+
+
+class ListChildStreamingInstrumentedView(EmbeddedInstrumentationMixin,
+                                         EmbeddedStreamingMixin,
+                                         ListCreateAPIView):
+    serializer_class = ChildSerializer
+    queryset = ChildModel.objects.all()
+    stream_chunk_size = 2
+
+
+class ListManyStreamingView(EmbeddedStreamingMixin, EmbeddedQuerySetMixin,
+                            ListCreateAPIView):
+    serializer_class = ManySerializer
+    queryset = ManyModel.objects.all()
+    stream_chunk_size = 2
+
+
+class ListParentView(ListCreateAPIView):
+    serializer_class = ParentWithChildrenSerializer
+    queryset = ParentModel.objects.all()
+
+
+class ListChildBulkView(EmbeddedBulkCreateMixin, ListCreateAPIView):
+    serializer_class = WritableChildSerializer
+    queryset = ChildModel.objects.all()
+
+
+class ListManyBulkView(EmbeddedBulkCreateMixin, ListCreateAPIView):
+    serializer_class = WritableManySerializer
+    queryset = ManyModel.objects.all()